@@ -0,0 +1,245 @@
+# The MIT License (MIT)
+# Copyright (c) 2017 Levak Borok <levak92@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import asyncio
+import hashlib
+import json
+
+from aiohttp import web
+
+from log import get_log
+
+log = get_log(__name__)
+
+### Immutable JSON snapshots of the tournament state
+#
+# A snapshot is serialized once and reused until its server state changes,
+# see RoleKeeper.touch. The serialized bytes and their ETag never change
+# once built.
+class Snapshots:
+    def __init__(self):
+        self.versions = {}
+        self.cache = {}
+
+    def touch(self, key):
+        self.versions[key] = self.versions.get(key, 0) + 1
+
+    def get(self, key, path, build):
+        version = self.versions.get(key, 0)
+        cached = self.cache.get((key, path))
+
+        if cached and cached[0] == version:
+            return cached[1], cached[2]
+
+        data = build()
+        if data is None:
+            return None, None
+
+        body = json.dumps(data, sort_keys=True).encode('utf-8')
+        etag = '"{}-{}"'.format(version, hashlib.sha1(body).hexdigest()[:16])
+        self.cache[(key, path)] = (version, body, etag)
+
+        return body, etag
+
+def match_state(match_id, match):
+    state = { 'match_id': match_id,
+              'format': match.format.name,
+              'teams': [ str(match.teamA), str(match.teamB) ],
+              'maps': [ { 'name': m,
+                          'state': 'ban' if m in match.banned_maps \
+                                   else 'pick' if m in match.picked_maps \
+                                   else None } for m in match.maps ],
+              'banned': list(match.banned_maps),
+              'picked': list(match.picked_maps),
+              'side': match.chosen_side,
+              'turn': match.turn,
+              'steps': len(match.format.steps),
+              'next': None,
+              'deadline': getattr(match, 'deadline', None),
+              'created': getattr(match, 'created', None) }
+
+    if not match.is_over():
+        team, action = match.step()
+        state['next'] = { 'team': str(team), 'action': action }
+
+    return state
+
+### Read-only HTTP API of the live tournament state
+#
+# Served from the in-memory DB only, it never calls the Discord API:
+#  - GET /api/servers
+#  - GET /api/{server}/matches
+#  - GET /api/{server}/matches/{match_id}
+#  - GET /api/{server}/teams
+#  - GET /api/{server}/captains
+#  - GET /api/events?server={server}&match={match_id}
+# where {server} is the `db` name of a configured server.
+class Api:
+    def __init__(self, bot, host='127.0.0.1', port=8080, events_buffer=100):
+        self.bot = bot
+        self.host = host
+        self.port = port
+        self.events_buffer = events_buffer
+        self.snapshots = Snapshots()
+        self.app = None
+        self.server = None
+
+    async def start(self):
+        loop = asyncio.get_event_loop()
+
+        app = web.Application(loop=loop)
+        app.router.add_route('GET', '/api/servers', self.get_servers)
+        app.router.add_route('GET', '/api/events', self.get_events)
+        app.router.add_route('GET', '/api/{server}/matches', self.get_matches)
+        app.router.add_route('GET', '/api/{server}/matches/{match_id}', self.get_match)
+        app.router.add_route('GET', '/api/{server}/teams', self.get_teams)
+        app.router.add_route('GET', '/api/{server}/captains', self.get_captains)
+        self.app = app
+
+        self.server = await loop.create_server(app.make_handler(), self.host, self.port)
+        log.info('API listening on http://{}:{}/api/'.format(self.host, self.port))
+
+    def touch(self, key):
+        self.snapshots.touch(key)
+
+    # Returns the DB of server `key`, or None
+    def find_db(self, key):
+        for server, db in self.bot.db.items():
+            if self.bot.config['servers'][server.name]['db'] == key:
+                return db
+        return None
+
+    def respond(self, request, key, build):
+        body, etag = self.snapshots.get(key, request.path, build)
+
+        if body is None:
+            return web.Response(status=404)
+
+        headers = { 'ETag': etag, 'Cache-Control': 'no-cache' }
+
+        if request.headers.get('If-None-Match') == etag:
+            return web.Response(status=304, headers=headers)
+
+        return web.Response(body=body, headers=headers,
+                            content_type='application/json')
+
+    async def get_servers(self, request):
+        def build():
+            return sorted([ self.bot.config['servers'][s.name]['db'] for s in self.bot.db ])
+        return self.respond(request, None, build)
+
+    async def get_matches(self, request):
+        key = request.match_info['server']
+
+        def build():
+            db = self.find_db(key)
+            if db is None:
+                return None
+            return [ match_state(match_id, match) \
+                     for match_id, match in sorted(db['matches'].items()) ]
+
+        return self.respond(request, key, build)
+
+    async def get_match(self, request):
+        key = request.match_info['server']
+        match_id = request.match_info['match_id']
+
+        def build():
+            db = self.find_db(key)
+            if db is None or match_id not in db['matches']:
+                return None
+            return match_state(match_id, db['matches'][match_id])
+
+        return self.respond(request, key, build)
+
+    async def get_teams(self, request):
+        key = request.match_info['server']
+
+        def build():
+            db = self.find_db(key)
+            if db is None:
+                return None
+            return [ { 'name': team.name, 'role': role_name } \
+                     for role_name, team in sorted(db['teams'].items()) ]
+
+        return self.respond(request, key, build)
+
+    async def get_captains(self, request):
+        key = request.match_info['server']
+
+        def build():
+            db = self.find_db(key)
+            if db is None:
+                return None
+            return [ { 'discord': captain.discord,
+                       'team': captain.team_name,
+                       'nickname': captain.nickname,
+                       'group': captain.group } \
+                     for _, captain in sorted(db['captains'].items()) ]
+
+        return self.respond(request, key, build)
+
+    # Server-sent event stream of the pick & ban events, see EventBus.
+    # Clients resume after their last event with the Last-Event-ID header
+    async def get_events(self, request):
+        last_id = request.headers.get('Last-Event-ID',
+                                      request.GET.get('last_event_id'))
+        try:
+            last_id = int(last_id) if last_id is not None else None
+        except ValueError:
+            last_id = None
+
+        subscriber = self.bot.events.subscribe(request.GET.get('server'),
+                                               request.GET.get('match'),
+                                               last_id,
+                                               self.events_buffer)
+
+        response = web.StreamResponse(headers={ 'Content-Type': 'text/event-stream',
+                                                'Cache-Control': 'no-cache' })
+        try:
+            await response.prepare(request)
+
+            while True:
+                try:
+                    event = await asyncio.wait_for(subscriber.queue.get(), 15)
+                except asyncio.TimeoutError:
+                    # Keep idle connections open through proxies
+                    response.write(b': keepalive\n\n')
+                    await response.drain()
+                    continue
+
+                if event is None:
+                    break
+
+                response.write('id: {}\nevent: {}\ndata: {}\n\n'\
+                               .format(event['id'],
+                                       event['type'],
+                                       json.dumps(event, sort_keys=True))\
+                               .encode('utf-8'))
+                await response.drain()
+
+        except (asyncio.CancelledError, ConnectionError):
+            pass
+
+        finally:
+            self.bot.events.unsubscribe(subscriber)
+
+        return response
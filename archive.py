@@ -0,0 +1,68 @@
+# The MIT License (MIT)
+# Copyright (c) 2017 Levak Borok <levak92@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import collections
+import gzip
+import json
+import os
+import threading
+
+from inputs import sanitize_input, translit_input
+
+### Compressed, append-only archive of finished matches
+#
+# One JSON summary record per line. Every append adds a gzip member to the
+# file, which gzip readers see as one continuous stream.
+class Archive:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def append(self, record):
+        line = json.dumps(record, sort_keys=True) + '\n'
+
+        with self.lock:
+            with gzip.open(self.path, 'at', encoding='utf-8') as f:
+                f.write(line)
+
+    def records(self):
+        if not os.path.exists(self.path):
+            return
+
+        with self.lock:
+            with gzip.open(self.path, 'rt', encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        yield json.loads(line)
+
+    # Returns the `limit` most recent records whose team names contain every
+    # word of `query`
+    def query(self, query='', limit=10):
+        words = [ sanitize_input(translit_input(w)) for w in query.split() ]
+        words = [ w for w in words if w ]
+
+        found = collections.deque(maxlen=limit)
+        for record in self.records():
+            teams = ' '.join(sanitize_input(translit_input(t)) for t in record['teams'])
+            if all(w in teams for w in words):
+                found.append(record)
+
+        return list(reversed(found))
@@ -0,0 +1,209 @@
+# The MIT License (MIT)
+# Copyright (c) 2017 Levak Borok <levak92@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import atexit
+import collections
+import gzip
+import json
+import os
+import queue
+import threading
+import time
+
+from log import get_log
+
+log = get_log(__name__)
+
+# Returns who triggered a mutation: the command and the member who typed it,
+# if any
+def audit_actor(command, member=None):
+    return { 'command': command,
+             'member': str(member) if member else None,
+             'id': member.id if member else None }
+
+# Returns the actor of the command in `message`
+def message_actor(message):
+    words = message.content.split()
+    return audit_actor(words[0] if words else None, message.author)
+
+# Returns the audited target of a mutation, `kind` is member, role or channel
+def audit_target(kind, obj):
+    return { 'type': kind,
+             'id': obj.id,
+             'name': str(obj) }
+
+# Returns the audited state of a member
+def member_state(member):
+    return { 'roles': sorted(r.name for r in member.roles if not r.is_everyone),
+             'nick': member.nick }
+
+### Background thread writing the records of every AuditLog
+#
+# Appending never blocks the event loop on the disk. Records are written in
+# order, and pending ones are flushed at exit.
+class AuditWriter:
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.thread = None
+        atexit.register(self.stop)
+
+    def start(self):
+        if self.thread:
+            return
+
+        self.thread = threading.Thread(target=self.run, name='audit', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if not self.thread:
+            return
+
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+
+    def put(self, audit, record):
+        self.start()
+        self.queue.put((audit, record))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+
+            audit, record = item
+            try:
+                audit.write(record)
+            except Exception as e:
+                log.error('Failed to write audit record: {}'.format(e), action='audit')
+
+writer = AuditWriter()
+
+### Compressed, rotating, append-only audit log of the Discord mutations
+#
+# One JSON record per gzip member, like Archive, so the file is still one
+# gzip stream. Every record also adds a `<member id> <offset> <length>` line
+# per member it concerns to a `.idx` file next to it, so looking up the
+# records of a member only decompresses these. Once the log reaches
+# `max_bytes`, it is rotated with its index to `.1`, `.2`, ... keeping
+# `backup_count` old files.
+class AuditLog:
+    def __init__(self, path, max_bytes=10 * 1024 * 1024, backup_count=5):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.lock = threading.Lock()
+        self.indexes = {}
+
+    # Queue `record` for the background writer. `members` are the IDs of the
+    # members the record is indexed by
+    def append(self, record, members=()):
+        record = dict(record, time=record.get('time', time.time()))
+        writer.put(self, (record, [ m for m in members if m ]))
+
+    def write(self, item):
+        record, members = item
+        data = gzip.compress((json.dumps(record, sort_keys=True) + '\n').encode('utf-8'))
+
+        with self.lock:
+            if os.path.exists(self.path) \
+               and os.path.getsize(self.path) + len(data) > self.max_bytes:
+                self.rotate()
+
+            with open(self.path, 'ab') as f:
+                offset = f.tell()
+                f.write(data)
+
+            if not members:
+                return
+
+            with open(self.path + '.idx', 'a', encoding='utf-8') as f:
+                for member_id in members:
+                    f.write('{} {} {}\n'.format(member_id, offset, len(data)))
+
+            index = self.indexes.get(self.path)
+            if index is not None:
+                for member_id in members:
+                    index[member_id].append((offset, len(data)))
+
+    def files(self):
+        return [ self.path ] + [ '{}.{}'.format(self.path, i) \
+                                 for i in range(1, self.backup_count + 1) ]
+
+    def rotate(self):
+        files = self.files()
+
+        for src, dst in reversed(list(zip(files, files[1:]))):
+            for ext in ('', '.idx'):
+                if os.path.exists(src + ext):
+                    os.replace(src + ext, dst + ext)
+
+        if not self.backup_count:
+            for ext in ('', '.idx'):
+                if os.path.exists(self.path + ext):
+                    os.remove(self.path + ext)
+
+        self.indexes.clear()
+
+    # Returns the { member id: [ (offset, length) ] } index of `path`, loaded
+    # once
+    def index(self, path):
+        if path in self.indexes:
+            return self.indexes[path]
+
+        index = collections.defaultdict(list)
+        if os.path.exists(path + '.idx'):
+            with open(path + '.idx', 'r', encoding='utf-8') as f:
+                for line in f:
+                    fields = line.split()
+                    if len(fields) == 3:
+                        index[fields[0]].append((int(fields[1]), int(fields[2])))
+
+        self.indexes[path] = index
+        return index
+
+    # Returns the `limit` most recent records of the member `member_id`,
+    # most recent first
+    def query(self, member_id, limit=10):
+        found = []
+
+        with self.lock:
+            for path in self.files():
+                if not os.path.exists(path):
+                    continue
+
+                entries = self.index(path).get(member_id, [])
+                if not entries:
+                    continue
+
+                with open(path, 'rb') as f:
+                    for offset, length in reversed(entries):
+                        f.seek(offset)
+                        try:
+                            found.append(json.loads(gzip.decompress(f.read(length)).decode('utf-8')))
+                        except (OSError, EOFError, ValueError):
+                            continue
+
+                        if len(found) >= limit:
+                            return found
+
+        return found
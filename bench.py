@@ -0,0 +1,273 @@
+#! /usr/bin/env python3
+
+# The MIT License (MIT)
+# Copyright (c) 2017 Levak Borok <levak92@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+# Offline micro-benchmarks for the pure-Python hot paths of RoleKeeper.
+#
+# Usage:
+#   ./bench.py                          run and print results
+#   ./bench.py --save baseline.json     run and store results as a baseline
+#   ./bench.py --compare baseline.json  run and compare against a baseline,
+#                                       exit code 1 if anything regressed
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+from inputs import sanitize_input, translit_input
+from match import Match
+from formats import compile_formats
+from stats import MapStats
+
+BASELINE_VERSION = 1
+
+MAPS = [ 'D-17', 'Factory', 'District', 'Destination', 'Bridges', 'Palace', 'Pyramid' ]
+
+# Typo'd, transliterated and badly cased map names as typed by captains
+MAP_INPUTS = [ 'd17', 'D 17', 'factori', 'Factory', 'distrikt', 'destenation',
+               'brigdes', 'palas', 'piramid', 'Пирамида', 'Дестинейшн', 'xyz' ]
+
+FORMATS = compile_formats({})
+
+TEAM_NAMES = [ 'Непобедимые', 'Волки', 'Альфа Команда', 'Звёздный Десант',
+               'Noobs', 'Pros', 'PGM', 'Team Ąęść', 'Ночные Совы', 'Бригада 42' ]
+
+### Minimal stand-ins for the Discord objects used by the benched code
+class FakeRole:
+    def __init__(self, name):
+        self.name = name
+        self.id = str(abs(hash(name)))
+        self.mention = '<@&{}>'.format(self.id)
+
+    def __str__(self):
+        return self.name
+
+class FakeServer:
+    def __init__(self, name, roles):
+        self.name = name
+        self.roles = roles
+
+class FakeHandle:
+    def __init__(self, team):
+        self.team = team
+
+    async def reply(self, msg):
+        return msg
+
+    async def send(self, msg):
+        return msg
+
+    async def broadcast(self, bcast_id, msg, compact=None):
+        return msg
+
+    def publish(self, type, data):
+        pass
+
+    def stats(self):
+        return MapStats({})
+
+def make_csv(path, rows, groups='ABCDEF'):
+    rng = random.Random(42)
+    with open(path, 'w') as f:
+        f.write('#discord,team,nickname,group\n')
+        for i in range(rows):
+            team = '{} {}'.format(rng.choice(TEAM_NAMES), i)
+            f.write('"user{i}#{d:04}","{team}","Игрок{i}",{g}\n'\
+                    .format(i=i, d=i % 10000, team=team, g=rng.choice(groups)))
+
+def timeit(func, number, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(number)
+        timings.append((time.perf_counter() - start) / number)
+    return timings
+
+def bench_sanitize_input(number):
+    for i in range(number):
+        sanitize_input(TEAM_NAMES[i % len(TEAM_NAMES)])
+
+def bench_translit_input(number):
+    for i in range(number):
+        translit_input(TEAM_NAMES[i % len(TEAM_NAMES)])
+
+def bench_find_map(number):
+    match = Match(FakeRole('A'), FakeRole('B'), MAPS, FORMATS['bo1'])
+    for i in range(number):
+        match.find_map(MAP_INPUTS[i % len(MAP_INPUTS)])
+
+def run_coroutine(coro):
+    return asyncio.get_event_loop().run_until_complete(coro)
+
+def bench_status(number):
+    teamA, teamB = FakeRole('A'), FakeRole('B')
+    match = Match(teamA, teamB, MAPS, FORMATS['bo1'])
+    match.banned_maps = MAPS[:3]
+    handle = FakeHandle(teamA)
+
+    async def loop():
+        for _ in range(number):
+            await match.status(handle)
+
+    run_coroutine(loop())
+
+def bench_check(number):
+    teamA, teamB = FakeRole('A'), FakeRole('B')
+    match = Match(teamA, teamB, MAPS, FORMATS['bo1'])
+    match.banned_maps = MAPS[:2]
+    handles = [ FakeHandle(teamA), FakeHandle(teamB) ]
+
+    async def loop():
+        for i in range(number):
+            await match.check('ban', handles[i % 2], MAPS[i % len(MAPS)])
+
+    run_coroutine(loop())
+
+def bench_parse_teams(number, rows=5000):
+    # Imported here so that the other benchmarks do not depend on discord.py
+    from rolekeeper import RoleKeeper
+
+    config = { 'roles': { 'group': 'Group {}' } }
+    server = FakeServer('bench', [ FakeRole('Group {}'.format(g)) for g in 'ABCDEF' ])
+
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'members.csv')
+        make_csv(path, rows)
+
+        rk = RoleKeeper.__new__(RoleKeeper)
+        rk.config = config
+        rk.db = { server: {} }
+
+        # Time the parsing, not the creation of the log records
+        logger = logging.getLogger('rolekeeper')
+        level = logger.level
+        logger.setLevel(logging.CRITICAL + 1)
+
+        try:
+            for _ in range(number):
+                rk.parse_teams(server, path)
+        finally:
+            logger.setLevel(level)
+
+# name: (function, iterations per sample)
+BENCHMARKS = {
+    'sanitize_input': (bench_sanitize_input, 20000),
+    'translit_input': (bench_translit_input, 2000),
+    'match.find_map': (bench_find_map, 500),
+    'match.status': (bench_status, 5000),
+    'match.check': (bench_check, 20000),
+    'rolekeeper.parse_teams_5000': (bench_parse_teams, 1),
+}
+
+def run(names, repeat):
+    results = {}
+    for name in names:
+        func, number = BENCHMARKS[name]
+        timings = timeit(func, number, repeat)
+        results[name] = { 'median': statistics.median(timings),
+                          'best': min(timings),
+                          'number': number,
+                          'repeat': repeat }
+        print('{:<30} {:>12.2f} us/op (best {:.2f})'\
+              .format(name, results[name]['median'] * 1e6, results[name]['best'] * 1e6))
+    return results
+
+def save(path, results):
+    with open(path, 'w') as f:
+        json.dump({ 'version': BASELINE_VERSION,
+                    'python': platform.python_version(),
+                    'machine': platform.machine(),
+                    'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                    'results': results },
+                  f, indent=2, sort_keys=True)
+    print('Saved baseline to "{}"'.format(path))
+
+def compare(path, results, threshold):
+    with open(path, 'r') as f:
+        baseline = json.load(f)
+
+    if baseline.get('version') != BASELINE_VERSION:
+        print('ERROR: Unsupported baseline version in "{}"'.format(path))
+        return False
+
+    ok = True
+    print('\nComparing against "{}" (threshold {:.0%}):'.format(path, threshold))
+    for name, result in results.items():
+        if name not in baseline['results']:
+            print('{:<30} {:>12}'.format(name, 'new'))
+            continue
+
+        old = baseline['results'][name]['median']
+        ratio = result['median'] / old if old else 1.0
+
+        status = 'ok'
+        if ratio > 1.0 + threshold:
+            status = 'REGRESSION'
+            ok = False
+        elif ratio < 1.0 - threshold:
+            status = 'faster'
+
+        print('{:<30} {:>+11.1%} {}'.format(name, ratio - 1.0, status))
+
+    return ok
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='RoleKeeper micro-benchmarks')
+    parser.add_argument('--save', metavar='FILE',
+                        help='store the results as a JSON baseline')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare the results against a JSON baseline')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='relative slowdown flagged as a regression (default: 0.10)')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='number of samples per benchmark (default: 5)')
+    parser.add_argument('names', nargs='*', metavar='NAME',
+                        help='benchmarks to run (default: all of {})'\
+                        .format(', '.join(BENCHMARKS)))
+    args = parser.parse_args(argv)
+
+    names = args.names or list(BENCHMARKS)
+    unknown = [ n for n in names if n not in BENCHMARKS ]
+    if unknown:
+        parser.error('unknown benchmark(s): {}'.format(', '.join(unknown)))
+
+    results = run(names, args.repeat)
+
+    if args.save:
+        save(args.save, results)
+
+    if args.compare:
+        if not compare(args.compare, results, args.threshold):
+            return 1
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
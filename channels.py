@@ -0,0 +1,87 @@
+# The MIT License (MIT)
+# Copyright (c) 2017 Levak Borok <levak92@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+from inputs import sanitize_input, translit_input
+
+MATCH_PREFIX = 'match_'
+
+### Name and ID index of the channels of one server
+#
+# Kept current by the channel create/delete/update events, so that lookups
+# do not scan every channel of the server.
+class ChannelIndex:
+    def __init__(self, server):
+        self.by_name = {}
+        self.by_id = {}
+        self.matches = set()
+
+        for channel in server.channels:
+            self.add(channel)
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def add(self, channel):
+        self.by_id[channel.id] = channel
+
+        # Keep the first channel of a name, as discord.utils.get would
+        if channel.name not in self.by_name:
+            self.by_name[channel.name] = channel
+
+        if channel.name.startswith(MATCH_PREFIX):
+            self.matches.add(channel.name)
+
+    def remove(self, channel):
+        self.by_id.pop(channel.id, None)
+
+        current = self.by_name.get(channel.name)
+
+        if current is not None and current.id == channel.id:
+            del self.by_name[channel.name]
+            self.matches.discard(channel.name)
+
+            # Another channel may share the name
+            for other in self.by_id.values():
+                if other.name == channel.name:
+                    self.add(other)
+                    break
+
+    def update(self, before, after):
+        self.remove(before)
+        self.add(after)
+
+    def get(self, name=None, id=None):
+        if id is not None:
+            return self.by_id.get(id)
+        return self.by_name.get(name)
+
+    # Returns the match rooms whose name contains every word of `query`,
+    # e.g. "wolves alpha" finds `match_wolves_vs_alphateam`
+    def find_matches(self, query):
+        words = [ sanitize_input(translit_input(w)) for w in query.split() ]
+        words = [ w for w in words if w ]
+
+        if not words:
+            return []
+
+        return sorted([ self.by_name[name] for name in self.matches \
+                        if all(w in name for w in words) ],
+                      key=lambda c: c.name)
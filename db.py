@@ -1,6 +1,14 @@
 import shelve
 import os
 
+from log import get_log
+
+log = get_log(__name__)
+
+# Path of a file stored next to the DB of `name`, e.g. its match archive
+def db_file(name, suffix):
+    return os.path.join('db', '{}{}'.format(name, suffix))
+
 def open_db(name):
     db = None
 
@@ -9,17 +17,18 @@ def open_db(name):
         folder = 'db'
         if not os.path.isdir(folder):
             if os.path.exists(folder):
-                print ('File "{}" already exists as a file'.format(folder))
+                log.error('File "{}" already exists as a file'.format(folder),
+                          db=name)
                 return None
 
             os.mkdir(folder)
 
         path = os.path.join(folder, filename)
-        print ('Opening DB "{}"'.format(path))
+        log.info('Opening DB "{}"'.format(path), db=name)
         db = shelve.open(path, writeback=True)
 
-    except:
-        print ('ERROR Cannot open database "{}"'.format(folder))
+    except Exception as e:
+        log.error('Cannot open database "{}": {}'.format(folder, e), db=name)
         db = None
         pass
 
@@ -0,0 +1,69 @@
+# The MIT License (MIT)
+# Copyright (c) 2017 Levak Borok <levak92@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import time
+
+# Header of a digest post, per broadcast
+DIGEST_TITLES = {
+    'match_created': ':sparkle: **{count}** match(es) created:',
+    'match_starting': ':arrow_forward: **{count}** match(es) starting:',
+}
+
+DEFAULT_TITLE = '**{count}** event(s) in `{bcast_id}`:'
+
+### Aggregates broadcasts of a room over a time window
+#
+# Events broadcast to a room with a digest window are buffered, and posted as
+# one compact multi-match message when the window ends. The windows are
+# driven by the shared bot timers.
+class Digests:
+    def __init__(self, timers, outbox):
+        self.timers = timers
+        self.outbox = outbox
+        self.pending = {}
+
+    def count(self):
+        return sum(len(lines) for _, lines in self.pending.values())
+
+    # Buffer `line` for broadcast `bcast_id`, to be posted in `channels`
+    def add(self, server, bcast_id, channels, line, window):
+        key = ('digest', server.id, bcast_id)
+
+        if key not in self.pending:
+            self.pending[key] = (channels, [])
+            self.timers.schedule(key, time.time() + window, self.flush, key, bcast_id)
+
+        self.pending[key][1].append(line)
+
+    async def flush(self, key, bcast_id):
+        channels, lines = self.pending.pop(key, (None, []))
+
+        if not lines:
+            return
+
+        title = DIGEST_TITLES.get(bcast_id, DEFAULT_TITLE)\
+                             .format(count=len(lines), bcast_id=bcast_id)
+
+        # The outbox packs the lines into as few posts as the limit allows
+        for channel in channels:
+            self.outbox.send(channel, title)
+            for line in lines:
+                self.outbox.send(channel, ' - {}'.format(line))
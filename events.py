@@ -0,0 +1,103 @@
+# The MIT License (MIT)
+# Copyright (c) 2017 Levak Borok <levak92@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import asyncio
+import collections
+import time
+
+from log import get_log
+
+log = get_log(__name__)
+
+### Subscriber of the event bus, with a bounded buffer
+#
+# A subscriber whose buffer is full is dropped: its buffer is replaced by a
+# single None, telling the reader to stop.
+class Subscriber:
+    def __init__(self, server=None, match=None, size=100):
+        self.server = server
+        self.match = match
+        self.queue = asyncio.Queue(maxsize=size)
+        self.dropped = False
+
+    def accepts(self, event):
+        return (self.server is None or event['server'] == self.server) \
+            and (self.match is None or event['match'] == self.match)
+
+    def push(self, event):
+        try:
+            self.queue.put_nowait(event)
+            return True
+        except asyncio.QueueFull:
+            self.drop()
+            return False
+
+    def drop(self):
+        self.dropped = True
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(None)
+
+### In-process publish/subscribe bus of pick & ban events
+#
+# Events get increasing IDs, and the last `history` ones are kept so that
+# reconnecting clients can resume after the last event they received. IDs
+# follow the current time in milliseconds, so that they still increase after
+# a restart and a client never gets an ID it has already seen.
+class EventBus:
+    def __init__(self, history=1000):
+        self.last_id = int(time.time() * 1000)
+        self.history = collections.deque(maxlen=history)
+        self.subscribers = set()
+
+    def publish(self, server, match, type, data):
+        self.last_id = max(self.last_id + 1, int(time.time() * 1000))
+        event = { 'id': self.last_id,
+                  'server': server,
+                  'match': match,
+                  'type': type,
+                  'time': time.time(),
+                  'data': data }
+        self.history.append(event)
+
+        for subscriber in list(self.subscribers):
+            if subscriber.accepts(event) and not subscriber.push(event):
+                log.warning('Dropped slow event subscriber',
+                            server=event['server'], match=event['match'], action='events')
+                self.subscribers.discard(subscriber)
+
+        return event
+
+    def subscribe(self, server=None, match=None, last_id=None, size=100):
+        subscriber = Subscriber(server, match, size)
+
+        # Replay what the client missed, if still in history and buffer
+        if last_id is not None:
+            missed = [ e for e in self.history \
+                       if e['id'] > last_id and subscriber.accepts(e) ]
+            for event in missed[-size:]:
+                subscriber.push(event)
+
+        self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self.subscribers.discard(subscriber)
@@ -0,0 +1,234 @@
+# The MIT License (MIT)
+# Copyright (c) 2017 Levak Borok <levak92@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+from log import get_log
+
+log = get_log(__name__)
+
+welcome_message_bo1 =\
+"""
+Welcome {m_teamA} and {m_teamB}!
+-- Match **BEST OF 1** --
+This text channel will be used by the judge and team captains to exchange anything about the match between teams {teamA} and {teamB}.
+This sequence is made using the `!ban` command team by team until one remains.
+Last team to ban also needs to chose the side they will play on using `!side xxxx` (attack or defend).
+
+For instance, team A types `!ban Pyramid` which will then ban the map _Pyramid_ from the match, team B types `!ban d17` which will ban the map D-17, and so on, until only one map remains. team B then picks the side using `!side attack`.
+"""
+
+welcome_message_bo2 =\
+"""
+Welcome {m_teamA} and {m_teamB}!
+-- Match **BEST OF 2** --
+This text channel will be used by the judge and team captains to exchange anything about the match between teams {teamA} and {teamB}.
+This sequence is made using the `!pick`, `!ban` and `!side` commands one by one using the following order:
+
+ - {teamA} bans, {teamB} bans,
+ - {teamA} picks, {teamB} picks,
+ - {teamB} picks the side (attack or defend).
+
+For instance, team A types `!ban Yard` which will then ban the map _Yard_ from the match, team B types `!ban d17` which will ban the map D-17. team A would then type `!pick Destination`, picking the first map and so on, until only one map remains, which will be the tie-breaker map. team B then picks the side using `!side attack`.
+"""
+
+welcome_message_bo3 =\
+"""
+Welcome {m_teamA} and {m_teamB}!
+-- Match **BEST OF 3** --
+This text channel will be used by the judge and team captains to exchange anything about the match between teams {teamA} and {teamB}.
+This sequence is made using the `!pick`, `!ban` and `!side` commands one by one using the following order:
+
+ - {teamA} bans, {teamB} bans,
+ - {teamA} picks, {teamB} picks,
+ - {teamA} bans, {teamB} bans,
+ - Last map remaining is the draw map,
+ - {teamB} picks the side (attack or defend).
+
+For instance, team A types `!ban Yard` which will then ban the map _Yard_ from the match, team B types `!ban d17` which will ban the map D-17. team A would then type `!pick Destination`, picking the first map and so on, until only one map remains, which will be the tie-breaker map. team B then picks the side using `!side attack`.
+"""
+
+# Built-in formats, `formats` in config.json can override them or add new ones
+#
+# - `sequence`: list of [team, action], team being A or B and action one of
+#   ban, pick or side;
+# - `maps`: size of the map pool the sequence is made for;
+# - `summary/maps`: maps played, in order. `map` is either `pick:N` (N-th
+#   picked map) or `remaining:N` (N-th map neither banned nor picked), `side`
+#   the team the chosen side applies to.
+DEFAULT_FORMATS = {
+    'bo1': {
+        'maps': 7,
+        'sequence': [ [ 'A', 'ban' ], [ 'B', 'ban' ],
+                      [ 'A', 'ban' ], [ 'B', 'ban' ],
+                      [ 'A', 'ban' ], [ 'B', 'ban' ],
+                      [ 'B', 'side' ] ],
+        'welcome': welcome_message_bo1,
+        'summary': {
+            'title': 'Ban sequence finished!',
+            'maps': [ { 'label': 'Map to play', 'map': 'remaining:0', 'side': 'B' } ],
+            'footer': ':warning: **And dont forget to screenshot the end result**! :warning:',
+        },
+    },
+    'bo2': {
+        'maps': 7,
+        'sequence': [ [ 'A', 'ban' ], [ 'B', 'ban' ],
+                      [ 'A', 'pick' ], [ 'B', 'pick' ],
+                      [ 'B', 'side' ] ],
+        'welcome': welcome_message_bo2,
+        'summary': {
+            'title': 'Pick & ban sequence finished!',
+            'maps': [ { 'label': 'Map 1', 'map': 'pick:0', 'side': 'B' },
+                      { 'label': 'Map 2', 'map': 'pick:1', 'side': 'A' } ],
+            'footer': ':warning: **And dont forget to screenshot all match results**! :warning:',
+        },
+    },
+    'bo3': {
+        'maps': 7,
+        'sequence': [ [ 'A', 'ban' ], [ 'B', 'ban' ],
+                      [ 'A', 'pick' ], [ 'B', 'pick' ],
+                      [ 'A', 'ban' ], [ 'B', 'ban' ],
+                      [ 'B', 'side' ] ],
+        'welcome': welcome_message_bo3,
+        'summary': {
+            'title': 'Pick & ban sequence finished!',
+            'maps': [ { 'label': 'Map 1', 'map': 'pick:0', 'side': 'B' },
+                      { 'label': 'Map 2', 'map': 'pick:1', 'side': 'A' },
+                      { 'label': 'Tie-breaker map', 'map': 'remaining:0', 'side': 'B' } ],
+            'footer': ':warning: **And dont forget to screenshot all match results**! :warning:',
+        },
+    },
+}
+
+TEAMS = { 'A': 0, 'B': 1 }
+ACTIONS = ( 'ban', 'pick', 'side' )
+
+# Compiled formats are interned, so that all matches of a format share the
+# same object, even the ones loaded back from the DB
+interned = {}
+
+def intern_format(*fields):
+    if fields not in interned:
+        interned[fields] = MatchFormat(*fields)
+    return interned[fields]
+
+### Immutable step table of a pick & ban format, see compile_format
+class MatchFormat:
+    __slots__ = ( 'name', 'map_count', 'steps', 'welcome',
+                  'summary_title', 'summary_maps', 'summary_footer' )
+
+    def __init__(self, name, map_count, steps, welcome,
+                 summary_title, summary_maps, summary_footer):
+        object.__setattr__(self, 'name', name)
+        object.__setattr__(self, 'map_count', map_count)
+        object.__setattr__(self, 'steps', steps)
+        object.__setattr__(self, 'welcome', welcome)
+        object.__setattr__(self, 'summary_title', summary_title)
+        object.__setattr__(self, 'summary_maps', summary_maps)
+        object.__setattr__(self, 'summary_footer', summary_footer)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('MatchFormat is immutable')
+
+    def fields(self):
+        return tuple(getattr(self, f) for f in self.__slots__)
+
+    def __reduce__(self):
+        return (intern_format, self.fields())
+
+    # Returns why the format cannot be played with the map pool `maps`, or
+    # None if it can
+    def check_pool(self, maps):
+        if len(maps) != self.map_count:
+            return 'made for {} maps, pool has {}'.format(self.map_count, len(maps))
+        return None
+
+    def __str__(self):
+        return self.name
+
+# Build the step table of format `name`, raises ValueError if it is invalid
+def compile_format(name, spec):
+    try:
+        map_count = int(spec['maps'])
+
+        steps = []
+        for team, action in spec['sequence']:
+            if team not in TEAMS or action not in ACTIONS:
+                raise ValueError('invalid step [{}, {}]'.format(team, action))
+            steps.append((TEAMS[team], action))
+
+        welcome = spec.get('welcome', '')
+        if isinstance(welcome, list):
+            welcome = '\n'.join(welcome)
+
+        summary = spec['summary']
+        summary_maps = []
+        for entry in summary['maps']:
+            source, index = entry['map'].split(':')
+            if source not in ('pick', 'remaining') or entry['side'] not in TEAMS:
+                raise ValueError('invalid summary map {}'.format(entry))
+            summary_maps.append((entry['label'], source, int(index), TEAMS[entry['side']]))
+
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError('Format "{}": {}'.format(name, e))
+
+    bans = sum(1 for _, a in steps if a == 'ban')
+    picks = sum(1 for _, a in steps if a == 'pick')
+    remaining = map_count - bans - picks
+
+    if remaining < 0:
+        raise ValueError('Format "{}": {} bans and picks for {} maps'\
+                         .format(name, bans + picks, map_count))
+
+    for label, source, index, _ in summary_maps:
+        available = picks if source == 'pick' else remaining
+        if index >= available:
+            raise ValueError('Format "{}": summary map "{}" refers to {} map #{} out of {}'\
+                             .format(name, label, source, index + 1, available))
+
+    return intern_format(name,
+                         map_count,
+                         tuple(steps),
+                         welcome,
+                         summary.get('title', 'Pick & ban sequence finished!'),
+                         tuple(summary_maps),
+                         summary.get('footer', ''))
+
+# Returns the built-in format `name`, the sequence matches had before
+# formats were configurable
+def legacy_format(name):
+    return compile_format(name, DEFAULT_FORMATS[name])
+
+# Compile the built-in formats and the ones from the configuration, once at
+# startup. Invalid formats are left out, and their errors appended to
+# `errors` if given
+def compile_formats(config, errors=None):
+    specs = dict(DEFAULT_FORMATS)
+    specs.update(config.get('formats', {}))
+
+    formats = {}
+    for name, spec in specs.items():
+        try:
+            formats[name] = compile_format(name, spec)
+        except ValueError as e:
+            log.error(str(e), action='formats')
+            if errors is not None:
+                errors.append(str(e))
+
+    return formats
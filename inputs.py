@@ -19,15 +19,52 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
 # IN THE SOFTWARE.
 
+import datetime
 import re
-import transliterate
+import time
+
+unsafe_chars = re.compile(r'[^a-zA-Z0-9]')
+relative_time = re.compile(r'^\+(?:(\d+)h)?(?:(\d+)m?)?$')
+clock_time = re.compile(r'^(\d{1,2})[:h](\d{2})$')
+
+# transliterate loads all its language packs on import, only pay for it
+# the first time a name actually needs to be transliterated
+transliterate = None
 
 def sanitize_input(input):
-    unsafe_chars = re.compile(r'[^a-zA-Z0-9]')
     return unsafe_chars.sub('', input.lower())
 
 def translit_input(input):
+    global transliterate
+
     try:
+        if transliterate is None:
+            import transliterate
         return transliterate.translit(input, reversed=True)
     except:
         return input
+
+# Parse a start time, either relative (`+45m`, `+2h`, `+1h30`) or a local
+# clock time (`20:30`, the next one to come). Returns a timestamp or None
+def parse_start(input, now=None):
+    now = time.time() if now is None else now
+    input = input.strip().lower()
+
+    match = relative_time.match(input)
+    if match and (match.group(1) or match.group(2)):
+        hours, minutes = int(match.group(1) or 0), int(match.group(2) or 0)
+        return now + hours * 3600 + minutes * 60
+
+    match = clock_time.match(input)
+    if match:
+        hours, minutes = int(match.group(1)), int(match.group(2))
+        if hours > 23 or minutes > 59:
+            return None
+
+        today = datetime.datetime.fromtimestamp(now)
+        start = today.replace(hour=hours, minute=minutes, second=0, microsecond=0)
+        if start <= today:
+            start += datetime.timedelta(days=1)
+        return start.timestamp()
+
+    return None
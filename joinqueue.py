@@ -0,0 +1,123 @@
+# The MIT License (MIT)
+# Copyright (c) 2017 Levak Borok <levak92@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+import asyncio
+import collections
+import time
+
+from log import get_log
+
+log = get_log(__name__)
+
+### Coalescing queue of member updates, drained at a bounded rate
+#
+# Members are queued once: events for a member already waiting are merged
+# into its pending entry, which keeps its original place and enqueue time.
+# `workers` tasks process the queue, starting at most `rate` updates per
+# second between them.
+class JoinQueue:
+    def __init__(self, handler, workers=2, rate=2.0):
+        self.handler = handler
+        self.workers = workers
+        self.interval = 1.0 / rate if rate else 0
+        self.pending = collections.OrderedDict()
+        self.wakeup = None
+        self.tasks = []
+        self.next_slot = 0
+
+        self.processed = 0
+        self.merged = 0
+        self.failed = 0
+        self.max_depth = 0
+        self.total_wait = 0
+        self.max_wait = 0
+
+    def __len__(self):
+        return len(self.pending)
+
+    def start(self):
+        if not self.tasks:
+            self.wakeup = asyncio.Event()
+            self.tasks = [ asyncio.ensure_future(self.work()) \
+                           for _ in range(self.workers) ]
+            if self.pending:
+                self.wakeup.set()
+
+    def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+
+    # Queue an update of `member`, merged with the pending one if any
+    def put(self, member):
+        key = (member.server.id, member.id)
+
+        if key in self.pending:
+            self.pending[key] = (member, self.pending[key][1])
+            self.merged += 1
+            return
+
+        self.pending[key] = (member, time.time())
+        self.max_depth = max(self.max_depth, len(self.pending))
+
+        if self.wakeup:
+            self.wakeup.set()
+
+    # Wait for the next slot allowed by the rate limit
+    async def throttle(self):
+        loop = asyncio.get_event_loop()
+        now = loop.time()
+        slot = max(now, self.next_slot)
+        self.next_slot = slot + self.interval
+
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def work(self):
+        while True:
+            if not self.pending:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+
+            await self.throttle()
+
+            if not self.pending:
+                continue
+
+            _, (member, queued) = self.pending.popitem(last=False)
+
+            wait = time.time() - queued
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+
+            try:
+                await self.handler(member)
+            except Exception as e:
+                self.failed += 1
+                log.error('Failed to update member "{}": {}'.format(member, e),
+                          server=member.server, member=member, action='member_join')
+
+            self.processed += 1
+
+    def average_wait(self):
+        return self.total_wait / self.processed if self.processed else 0
@@ -0,0 +1,119 @@
+# The MIT License (MIT)
+# Copyright (c) 2017 Levak Borok <levak92@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+import atexit
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+
+FIELDS = ( 'server', 'match', 'member', 'action', 'duration' )
+
+### One JSON object per line, with the structured fields of the record
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = { 'time': datetime.datetime.fromtimestamp(record.created).isoformat(),
+                  'level': record.levelname,
+                  'logger': record.name,
+                  'msg': record.getMessage() }
+
+        for name, value in getattr(record, 'fields', {}).items():
+            entry[name] = value
+
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, ensure_ascii=False, sort_keys=True)
+
+### Logger taking structured fields as keyword arguments
+#
+#   log.info('Renamed "{}"'.format(member), server=server, member=member,
+#            action='rename')
+#
+# Fields other than numbers are logged as strings, see FIELDS for the usual
+# ones.
+class EventLog:
+    def __init__(self, name):
+        self.logger = logging.getLogger(name)
+
+    def log(self, level, msg, exc_info=False, **fields):
+        if not self.logger.isEnabledFor(level):
+            return
+
+        fields = { name: value if value is None or isinstance(value, (int, float)) \
+                         else str(value) \
+                   for name, value in fields.items() }
+        self.logger.log(level, msg, exc_info=exc_info, extra={ 'fields': fields })
+
+    def debug(self, msg, **fields):
+        self.log(logging.DEBUG, msg, **fields)
+
+    def info(self, msg, **fields):
+        self.log(logging.INFO, msg, **fields)
+
+    def warning(self, msg, **fields):
+        self.log(logging.WARNING, msg, **fields)
+
+    def error(self, msg, **fields):
+        self.log(logging.ERROR, msg, **fields)
+
+def get_log(name):
+    return EventLog(name)
+
+# Route all records through a queue to a background thread writing them to
+# the console and, if configured, to a size-rotated JSON lines file, so that
+# logging never blocks the event loop on I/O. `config` is the `logging`
+# object of config.json.
+def setup_logging(config):
+    level = getattr(logging, config.get('level', 'INFO').upper(), logging.INFO)
+
+    handlers = []
+
+    if config.get('console', True):
+        console = logging.StreamHandler()
+        console.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+        handlers.append(console)
+
+    if config.get('file'):
+        folder = os.path.dirname(config['file'])
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+        rotating = logging.handlers.RotatingFileHandler(config['file'],
+                                                        maxBytes=config.get('max_bytes', 10 * 1024 * 1024),
+                                                        backupCount=config.get('backup_count', 5),
+                                                        encoding='utf-8')
+        rotating.setFormatter(JsonFormatter())
+        handlers.append(rotating)
+
+    records = queue.Queue(-1)
+    listener = logging.handlers.QueueListener(records, *handlers)
+    listener.start()
+    atexit.register(listener.stop)
+
+    root = logging.getLogger()
+    root.handlers = [ logging.handlers.QueueHandler(records) ]
+    root.setLevel(level)
+
+    return listener
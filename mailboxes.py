@@ -0,0 +1,92 @@
+# The MIT License (MIT)
+# Copyright (c) 2017 Levak Borok <levak92@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import asyncio
+import collections
+
+### Ordered queue of commands for one match room
+#
+# Commands posted to the same mailbox run one after the other, in arrival
+# order. The worker task only lives while there is something to process.
+class Mailbox:
+    def __init__(self, key):
+        self.key = key
+        self.queue = collections.deque()
+        self.task = None
+        self.processed = 0
+        self.max_depth = 0
+
+    def depth(self):
+        return len(self.queue) + (1 if self.task else 0)
+
+    def post(self, func, *args):
+        future = asyncio.Future()
+        self.queue.append((future, func, args))
+        self.max_depth = max(self.max_depth, self.depth())
+
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+
+        return future
+
+    async def run(self):
+        try:
+            while self.queue:
+                future, func, args = self.queue.popleft()
+
+                try:
+                    result = await func(*args)
+                except Exception as e:
+                    if not future.cancelled():
+                        future.set_exception(e)
+                else:
+                    if not future.cancelled():
+                        future.set_result(result)
+
+                self.processed += 1
+        finally:
+            self.task = None
+
+### All match mailboxes, one per (server, channel)
+class Mailboxes:
+    def __init__(self):
+        self.boxes = {}
+
+    # Run coroutine function `func(*args)` in the mailbox `key` and wait for
+    # its result
+    async def submit(self, key, func, *args):
+        if key not in self.boxes:
+            self.boxes[key] = Mailbox(key)
+
+        return await self.boxes[key].post(func, *args)
+
+    def discard(self, key):
+        box = self.boxes.get(key)
+        if box and box.depth() == 0:
+            del self.boxes[key]
+
+    def depths(self, server_id=None):
+        return { key: box.depth() for key, box in self.boxes.items() \
+                 if server_id is None or key[0] == server_id }
+
+    def max_depth(self, server_id=None):
+        return max([ box.max_depth for key, box in self.boxes.items() \
+                     if server_id is None or key[0] == server_id ] or [ 0 ])
@@ -23,9 +23,13 @@
 
 import discord
 import asyncio
+import re
 import sys
 
 from rolekeeper import RoleKeeper
+from log import get_log, setup_logging
+from inputs import parse_start
+from audit import message_actor
 
 import json
 
@@ -43,20 +47,78 @@ def get_config(path):
               .format(e.msg, e.lineno, e.colno))
         return None
 
+log = get_log(__name__)
+
 client = discord.Client()
 
 @client.event
 async def on_ready():
-    print('Logged in as')
-    print(client.user.name)
-    print(client.user.id)
-    print('------')
+    log.info('Logged in as "{}" ({})'.format(client.user.name, client.user.id))
     await rk.on_ready()
 
 @client.event
 async def on_member_join(member):
     await rk.on_member_join(member)
 
+@client.event
+async def on_member_update(before, after):
+    rk.on_member_update(before, after)
+
+@client.event
+async def on_member_remove(member):
+    rk.on_member_remove(member)
+
+@client.event
+async def on_channel_create(channel):
+    rk.on_channel_create(channel)
+
+@client.event
+async def on_channel_delete(channel):
+    rk.on_channel_delete(channel)
+
+@client.event
+async def on_channel_update(before, after):
+    rk.on_channel_update(before, after)
+
+@client.event
+async def on_server_role_create(role):
+    rk.on_server_role_change(role)
+
+@client.event
+async def on_server_role_delete(role):
+    rk.on_server_role_change(role)
+
+@client.event
+async def on_server_role_update(before, after):
+    rk.on_server_role_change(after)
+
+async def match_command(message, mode, names, usage, start=None):
+    teams = [ name.strip() for name in re.split(r'\s+vs\s+', names, flags=re.IGNORECASE) ]
+
+    if len(message.role_mentions) == 2 and mode and start:
+        await rk.schedule_match(message,
+                                message.author.server,
+                                message.role_mentions[0],
+                                message.role_mentions[1],
+                                mode,
+                                start)
+    elif len(message.role_mentions) == 2 and mode:
+        await rk.matchup(message,
+                         message.author.server,
+                         message.role_mentions[0],
+                         message.role_mentions[1],
+                         mode=mode)
+    elif len(message.role_mentions) == 0 and len(teams) == 2 and all(teams) and mode:
+        await rk.matchup_by_name(message,
+                                 message.author.server,
+                                 teams[0],
+                                 teams[1],
+                                 mode=mode,
+                                 start=start)
+    else:
+        await rk.reply(message,
+                       'Too much or not enough arguments:\n```{0} @xxx @yyy\n{0} team xxx vs team yyy```'.format(usage))
+
 @client.event
 async def on_message(message):
     # If message is a DM
@@ -64,10 +126,11 @@ async def on_message(message):
         await rk.on_dm(message)
         return
 
-    is_admin = message.author.server_permissions.manage_roles
-    is_ref = discord.utils.get(message.author.roles, name=rk.config['roles']['referee']) or is_admin
-    is_captain_in_match = rk.is_captain_in_match(message.author, message.channel) or is_admin or is_ref
-    is_streamer = discord.utils.get(message.author.roles, name=rk.config['roles']['streamer']) or is_admin
+    perms = rk.get_permissions(message.author)
+    is_admin = perms.is_admin
+    is_ref = perms.is_ref
+    is_captain_in_match = perms.is_captain_in(message.channel.name) or is_ref
+    is_streamer = perms.is_streamer
 
     if len(message.content) <= 0:
         return
@@ -79,15 +142,18 @@ async def on_message(message):
     #----------------
 
     if command == '!refresh' and is_admin:
-        await rk.refresh(message.author.server)
+        await rk.refresh(message.author.server,
+                         message.channel,
+                         dry_run=args == 'dry',
+                         actor=message_actor(message))
     elif command == '!create_teams' and is_admin:
-        await rk.create_all_roles(message.author.server)
+        await rk.create_all_roles(message.author.server, message_actor(message))
 
     elif command == '!wipe_teams' and is_admin:
-        await rk.wipe_teams(message.author.server)
+        await rk.wipe_teams(message.author.server, message.channel, message_actor(message))
 
     elif command == '!wipe_matches' and is_admin:
-        await rk.wipe_matches(message.author.server)
+        await rk.wipe_matches(message.author.server, message.channel, message_actor(message))
 
     elif command == '!wipe_messages' and is_admin:
         if len(message.channel_mentions) < 1:
@@ -102,6 +168,28 @@ async def on_message(message):
     elif command == '!members' and is_admin:
         await rk.export_members(args, message)
 
+    elif command == '!metrics' and is_admin:
+        await rk.metrics(message)
+
+    elif command == '!reload' and is_admin:
+        await rk.reload_config(message.channel)
+
+    elif command == '!snapshot' and is_admin:
+        if args == 'export':
+            await rk.export_snapshot(message)
+        elif args == 'import':
+            await rk.import_snapshot(message)
+        else:
+            await rk.reply(message,
+                           'Not enough arguments:\n```!snapshot export|import```')
+
+    elif command == '!audit' and is_admin:
+        if len(message.mentions) == 1:
+            await rk.audit_member(message, message.mentions[0])
+        else:
+            await rk.reply(message,
+                           'Too much or not enough arguments:\n```!audit @xxx```')
+
     # REF COMMANDS
     #--------------
 
@@ -127,38 +215,45 @@ async def on_message(message):
             await rk.reply(message,
                            'Too much or not enough arguments:\n```!remove_captain @xxx```')
 
-    elif command == '!bo1' and is_ref:
-        if len(message.role_mentions) == 2:
-            await rk.matchup(message,
-                             message.author.server,
-                             message.role_mentions[0],
-                             message.role_mentions[1],
-                             mode=RoleKeeper.MATCH_BO1)
+    elif command in [ '!bo1', '!bo2', '!bo3' ] and is_ref:
+        # Shortcuts for `!match boX`
+        await match_command(message, command[1:], args, command)
+
+    elif command == '!match' and is_ref:
+        parts = args.split(None, 1)
+        await match_command(message,
+                            parts[0] if len(parts) > 0 else '',
+                            parts[1] if len(parts) > 1 else '',
+                            '!match format')
+
+    elif command == '!schedule' and is_ref:
+        parts = args.split(None, 2)
+        if len(parts) == 0:
+            await rk.list_schedule(message)
         else:
-            await rk.reply(message,
-                           'Too much or not enough arguments:\n```!bo1 @xxx @yyy```')
-
-    elif command == '!bo2' and is_ref:
-        if len(message.role_mentions) == 2:
-            await rk.matchup(message,
-                             message.author.server,
-                             message.role_mentions[0],
-                             message.role_mentions[1],
-                             mode=RoleKeeper.MATCH_BO2)
-        else:
-            await rk.reply(message,
-                           'Too much or not enough arguments:\n```!bo2 @xxx @yyy```')
-
-    elif command == '!bo3' and is_ref:
-        if len(message.role_mentions) == 2:
-            await rk.matchup(message,
-                             message.author.server,
-                             message.role_mentions[0],
-                             message.role_mentions[1],
-                             mode=RoleKeeper.MATCH_BO3)
+            start = parse_start(parts[1]) if len(parts) > 1 else None
+            if start is None:
+                await rk.reply(message,
+                               'Invalid start time, use `+45m`, `+1h30` or `20:30`:\n```!schedule format time @xxx @yyy```')
+            else:
+                await match_command(message,
+                                    parts[0],
+                                    parts[2] if len(parts) > 2 else '',
+                                    '!schedule format time',
+                                    start=start)
+
+    elif command == '!unschedule' and is_ref:
+        if len(args) > 0:
+            await rk.unschedule_match(message, args.split()[0])
         else:
             await rk.reply(message,
-                           'Too much or not enough arguments:\n```!bo3 @xxx @yyy```')
+                           'Not enough arguments:\n```!unschedule match_id```')
+
+    elif command == '!history' and is_ref:
+        await rk.match_history(message, args)
+
+    elif command == '!mapstats' and is_ref:
+        await rk.map_stats(message, args)
 
     elif command == '!say' and is_ref:
         parts = args.split()
@@ -169,9 +264,9 @@ async def on_message(message):
             channel_id = parts[0]
             if channel_id.startswith('<'):
                 channel_id = channel_id[2:-1]
-                channel = discord.utils.get(message.author.server.channels, id=channel_id)
+                channel = rk.get_channel(message.author.server, id=channel_id)
             else:
-                channel = discord.utils.get(message.author.server.channels, name=channel_id)
+                channel = rk.get_channel(message.author.server, name=channel_id)
 
             if channel:
                 msg = args.replace(parts[0], '', 1)
@@ -207,23 +302,29 @@ async def on_message(message):
                              args.split()[0] if len(args) > 0 else '',
                              force=is_ref)
 
+    elif command in [ '!ban', '!pick', '!side' ] \
+         and rk.is_finished_room(message.server, message.channel):
+        await rk.reply(message, 'This match is over, see `!history` for its summary')
+
     # STREAMER COMMANDS
     #-------------------
 
     elif command == '!stream' and is_streamer:
-        await rk.stream_match(message,
-                              args.split()[0] if len(args) > 0 else '')
+        await rk.stream_match(message, args)
 
 if __name__ == '__main__':
 
     config = None
+    config_path = 'config.json'
 
     if len(sys.argv) > 1:
-        config = get_config(sys.argv[1])
+        config_path = sys.argv[1]
     else:
         print('Using default configuration file path: `config.json`')
-        config = get_config('config.json')
+
+    config = get_config(config_path)
 
     if config:
-        rk = RoleKeeper(client, config)
+        setup_logging(config.get('logging', {}))
+        rk = RoleKeeper(client, config, config_path)
         client.run(config['app_bot_token'])
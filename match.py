@@ -20,30 +20,70 @@
 # IN THE SOFTWARE.
 
 import asyncio
+import random
+import time
 
 from difflib import SequenceMatcher
 from inputs import sanitize_input, translit_input
+from team import role_ref
+from formats import legacy_format
+from log import get_log
 
+log = get_log(__name__)
+
+### Pick & ban sequence of a match, following a compiled MatchFormat
 class Match:
-    def __init__(self, teamA, teamB, maps):
-        self.teams = [ teamA, teamB ]
-        self.teamA = teamA
-        self.teamB = teamB
-        self.maps = maps
+    legacy_format = 'bo1'
+
+    def __init__(self, teamA, teamB, maps, format):
+        # Only role IDs are kept, see RoleRef
+        self.teamA = role_ref(teamA)
+        self.teamB = role_ref(teamB)
+        self.teams = [ self.teamA, self.teamB ]
+        self.maps = list(maps)
+        self.format = format
         self.banned_maps = []
         self.picked_maps = []
         self.chosen_side = None
         self.turn = 0
-        self.sequence = [ (teamA, 'ban'), (teamB, 'ban'),
-                          (teamA, 'ban'), (teamB, 'ban'),
-                          (teamA, 'ban'), (teamB, 'ban'),
-                          (teamB, 'side') ]
+        self.created = time.time()
+
+        # Timestamp before which the current turn has to be played, see
+        # RoleKeeper.arm_deadline
+        self.deadline = None
+        self.deadline_turn = None
+        self.reminded = False
 
         self.sides = { 'defends': [ 'defends', 'defend', 'defense', 'defence', 'warface', 'def', 'd' ],
                        'attacks' : [ 'attacks', 'attack', 'attacking', 'blackwood', 'offense', 'att', 'a' ] }
 
+    # Matches pickled before formats were configurable have no `format` but
+    # a `sequence` of Discord roles, see MatchBo2 and MatchBo3. Give them the
+    # built-in format of their class, and the attributes added since
+    def __setstate__(self, state):
+        state.pop('sequence', None)
+        self.__dict__.update(state)
+
+        if 'format' not in state:
+            self.format = legacy_format(type(self).legacy_format)
+
+        for name, default in (('created', None),
+                              ('deadline', None),
+                              ('deadline_turn', None),
+                              ('reminded', False)):
+            if name not in state:
+                setattr(self, name, default)
+
+    # Returns the (team, action) of the given turn, the current one by default
+    def step(self, turn=None):
+        team, action = self.format.steps[self.turn if turn is None else turn]
+        return self.teams[team], action
+
+    def is_over(self):
+        return self.turn >= len(self.format.steps)
+
     def is_in_match(self, member):
-        return self.teamA in member.roles or self.teamB in member.roles
+        return any(r.id == self.teamA.id or r.id == self.teamB.id for r in member.roles)
 
     def find_map(self, map_name):
         try:
@@ -55,12 +95,22 @@ class Match:
         except StopIteration:
             return None
 
+    # Returns a random valid choice for the given action, used when a team
+    # runs out of time
+    def random_choice(self, action):
+        if action == 'side':
+            return random.choice(sorted(self.sides.keys()))
+
+        available = [ m for m in self.maps \
+                      if m not in self.banned_maps and m not in self.picked_maps ]
+        return random.choice(available) if available else None
+
     async def check(self, action, handle, map_id, force=False):
-        if self.turn >= len(self.sequence):
+        if self.is_over():
             await handle.reply("Pick & Ban sequence is over!")
             return False
 
-        team, check_action = self.sequence[self.turn]
+        team, check_action = self.step()
 
         if team != handle.team and not force:
             await handle.reply('Not your turn to {}!'.format(action))
@@ -92,8 +142,16 @@ class Match:
         return True
 
     async def begin(self, handle):
+        handle.publish('match_created', { 'format': self.format.name,
+                                          'teams': [ str(self.teamA), str(self.teamB) ],
+                                          'maps': list(self.maps) })
+        handle.stats().count_match(self.format.name, self.maps)
         await self.status(handle)
         await handle.broadcast('match_created', ':sparkle: Match created: `{match_id}`\n**{teamA}** vs **{teamB}**\n'\
+                               .format(teamA=self.teamA,
+                                       teamB=self.teamB,
+                                       match_id=handle.channel.name),
+                               compact='`{match_id}`: **{teamA}** vs **{teamB}**'\
                                .format(teamA=self.teamA,
                                        teamB=self.teamB,
                                        match_id=handle.channel.name))
@@ -105,11 +163,16 @@ class Match:
         if not await self.check('ban', handle, banned_map_id, force):
             return
 
+        team, _ = self.step()
         self.banned_maps.append(banned_map_id)
-        print('{ch}: {team} banned map {map}'\
-              .format(ch=handle.channel,
-                      team=handle.team,
-                      map=banned_map_id))
+        handle.publish('ban', { 'team': str(team), 'map': banned_map_id })
+        handle.stats().count_map(self.format.name, 'ban', banned_map_id)
+        log.info('{ch}: {team} banned map {map}'\
+                 .format(ch=handle.channel,
+                         team=handle.team,
+                         map=banned_map_id),
+                 server=handle.channel.server, match=handle.channel.name,
+                 member=handle.member, action='ban')
         await self.update_turn(handle)
 
     async def pick_map(self, handle, picked_map, force=False):
@@ -118,11 +181,16 @@ class Match:
         if not await self.check('pick', handle, picked_map_id, force):
             return
 
+        team, _ = self.step()
         self.picked_maps.append(picked_map_id)
-        print('{ch}: {team} picked map {map}'\
-              .format(ch=handle.channel,
-                      team=handle.team,
-                      map=picked_map_id))
+        handle.publish('pick', { 'team': str(team), 'map': picked_map_id })
+        handle.stats().count_map(self.format.name, 'pick', picked_map_id)
+        log.info('{ch}: {team} picked map {map}'\
+                 .format(ch=handle.channel,
+                         team=handle.team,
+                         map=picked_map_id),
+                 server=handle.channel.server, match=handle.channel.name,
+                 member=handle.member, action='pick')
         await self.update_turn(handle)
 
     async def choose_side(self, handle, chosen_side, force=False):
@@ -134,98 +202,111 @@ class Match:
         if not await self.check('side', handle, side_id, force):
             return
 
+        team, _ = self.step()
         self.chosen_side = side_id
-        print('{ch}: {team} chose side {side}'\
-              .format(ch=handle.channel,
-                      team=handle.team,
-                      side=side_id))
+        handle.publish('side', { 'team': str(team), 'side': side_id })
+        handle.stats().count_side(self.format.name, side_id)
+        log.info('{ch}: {team} chose side {side}'\
+                 .format(ch=handle.channel,
+                         team=handle.team,
+                         side=side_id),
+                 server=handle.channel.server, match=handle.channel.name,
+                 member=handle.member, action='side')
         await self.update_turn(handle)
 
     async def update_turn(self, handle):
         self.turn += 1
         await self.status(handle)
-        if self.turn >= len(self.sequence):
+        if self.is_over():
             await self.summary(handle)
 
     async def status(self, handle):
         msg = '\n'.join([' - {:<15} {:>6}'.format(m, '[ban]' if m in self.banned_maps else '[pick]' if m in self.picked_maps else '~  ') for m in self.maps ])
-        if self.turn >= len(self.sequence):
+        if self.is_over():
             turn = ''
         else:
+            team, action = self.step()
             turn = 'Your turn {team}! Use `!{action} xxxxx`.'\
-                .format(team=self.sequence[self.turn][0].mention,
-                        action=self.sequence[self.turn][1])
+                .format(team=team.mention,
+                        action=action)
 
         await handle.send('Current sequence status ({i}/{n}):\n```\n{msg}\n```\n{turn}'\
                           .format(i=self.turn,
-                                  n=len(self.sequence),
+                                  n=len(self.format.steps),
                                   msg=msg,
                                   turn=turn))
 
+    # Returns the maps to play as (label, map, team the side applies to),
+    # following the summary layout of the format
+    def played_maps(self):
+        remaining = [ m for m in self.maps \
+                      if m not in self.banned_maps and m not in self.picked_maps ]
+
+        played = []
+        for label, source, index, team in self.format.summary_maps:
+            map_id = self.picked_maps[index] if source == 'pick' else remaining[index]
+            played.append((label, map_id, self.teams[team]))
+
+        return played
+
+    # Small summary record of a finished match, kept in the match archive
+    def record(self, match_id):
+        return { 'match_id': match_id,
+                 'format': self.format.name,
+                 'teams': [ str(self.teamA), str(self.teamB) ],
+                 'banned': list(self.banned_maps),
+                 'picked': list(self.picked_maps),
+                 'side': self.chosen_side,
+                 'maps': [ { 'label': label, 'map': map_id, 'team': str(team) } \
+                           for label, map_id, team in self.played_maps() ],
+                 'created': getattr(self, 'created', None),
+                 'finished': time.time() }
+
     async def summary(self, handle):
-        map_id = next(e for e in self.maps if e not in self.banned_maps)
-        await handle.send('Ban sequence finished!\n\nMap to play: **{map1}** ({teamB} **{side}**)\nglhf!\n\n:warning: **And dont forget to screenshot the end result**! :warning: '\
-                          .format(teamA=self.teamA,
-                                  teamB=self.teamB,
-                                  map1=map_id,
-                                  side=self.chosen_side))
-
-        await handle.broadcast('match_starting', ':arrow_forward: Match starting: `{match_id}`\n**{teamA}** vs **{teamB}**\n - Map: **{map1}** ({teamB} **{side}**)\n'\
+        played = self.played_maps()
+
+        handle.publish('summary', { 'side': self.chosen_side,
+                                    'maps': [ { 'label': label, 'map': map_id, 'team': str(team) } \
+                                              for label, map_id, team in played ] })
+
+        stats = handle.stats()
+        for _, map_id, _ in played:
+            stats.count_played(self.format.name, map_id, self.chosen_side)
+
+        await handle.send('{title}\n\n{maps}\nglhf!\n\n{footer}'\
+                          .format(title=self.format.summary_title,
+                                  maps='\n'.join([ '{label}: **{map}** ({team} **{side}**)'\
+                                                   .format(label=label,
+                                                           map=map_id,
+                                                           team=team,
+                                                           side=self.chosen_side)
+                                                   for label, map_id, team in played ]),
+                                  footer=self.format.summary_footer))
+
+        await handle.broadcast('match_starting', ':arrow_forward: Match starting: `{match_id}`\n**{teamA}** vs **{teamB}**\n{maps}\n'\
+                               .format(teamA=self.teamA,
+                                       teamB=self.teamB,
+                                       maps='\n'.join([ ' - {label}: **{map}** ({team} **{side}**)'\
+                                                        .format(label=label,
+                                                                map=map_id,
+                                                                team=team,
+                                                                side=self.chosen_side)
+                                                        for label, map_id, team in played ]),
+                                       match_id=handle.channel.name),
+                               compact='`{match_id}`: **{teamA}** vs **{teamB}** - {maps}'\
                                .format(teamA=self.teamA,
                                        teamB=self.teamB,
-                                       map1=map_id,
-                                       side=self.chosen_side,
+                                       maps=', '.join([ '{map} ({team} {side})'\
+                                                       .format(map=map_id,
+                                                               team=team,
+                                                               side=self.chosen_side)
+                                                       for _, map_id, team in played ]),
                                        match_id=handle.channel.name))
 
-
+### Match classes of the DBs written before formats were configurable, only
+# kept so that these DBs still load, see Match.__setstate__
 class MatchBo2(Match):
-    def __init__(self, teamA, teamB, maps):
-        Match.__init__(self, teamA, teamB, maps)
-
-        self.sequence = [ (teamA, 'ban'), (teamB, 'ban'),
-                          (teamA, 'pick'), (teamB, 'pick'),
-                          (teamB, 'side') ]
-
-    async def summary(self, handle):
-        await handle.send('Pick & ban sequence finished!\n\nMap 1: **{map1}** ({teamB} **{side}**)\nMap 2: **{map2}** ({teamA} **{side}**)\nglhf!\n\n:warning: **And dont forget to screenshot all match results**! :warning:'\
-                          .format(teamA=self.teamA,
-                                  teamB=self.teamB,
-                                  map1=self.picked_maps[0],
-                                  map2=self.picked_maps[1],
-                                  side=self.chosen_side))
-
-        await handle.broadcast('match_starting', ':arrow_forward: Match starting: `{match_id}`\n**{teamA}** vs **{teamB}**\n - Map 1: **{map1}** ({teamB} **{side}**)\n - Map 2: **{map2}** ({teamA} **{side}**)\n'\
-                          .format(teamA=self.teamA,
-                                  teamB=self.teamB,
-                                  map1=self.picked_maps[0],
-                                  map2=self.picked_maps[1],
-                                  side=self.chosen_side,
-                                  match_id=handle.channel.name))
+    legacy_format = 'bo2'
 
 class MatchBo3(Match):
-    def __init__(self, teamA, teamB, maps):
-        Match.__init__(self, teamA, teamB, maps)
-
-        self.sequence = [ (teamA, 'ban'), (teamB, 'ban'),
-                          (teamA, 'pick'), (teamB, 'pick'),
-                          (teamA, 'ban'), (teamB, 'ban'),
-                          (teamB, 'side') ]
-
-    async def summary(self, handle):
-        map_id = next(e for e in self.maps if e not in self.banned_maps and e not in self.picked_maps)
-        await handle.send('Pick & ban sequence finished!\n\nMap 1: **{map1}** ({teamB} **{side}**)\nMap 2: **{map2}** ({teamA} **{side}**)\nTie-breaker map: **{map3}** ({teamB} **{side}**)\nglhf!\n\n:warning: **And dont forget to screenshot all match results**! :warning:'\
-                          .format(teamA=self.teamA,
-                                  teamB=self.teamB,
-                                  map1=self.picked_maps[0],
-                                  map2=self.picked_maps[1],
-                                  map3=map_id,
-                                  side=self.chosen_side))
-
-        await handle.broadcast('match_starting', ':arrow_forward: Match starting: `{match_id}`\n**{teamA}** vs **{teamB}**\n - Map 1: **{map1}** ({teamB} **{side}**)\n - Map 2: **{map2}** ({teamA} **{side}**)\n - Tie-breaker map: **{map3}** ({teamB} **{side}**)\n'\
-                          .format(teamA=self.teamA,
-                                  teamB=self.teamB,
-                                  map1=self.picked_maps[0],
-                                  map2=self.picked_maps[1],
-                                  map3=map_id,
-                                  side=self.chosen_side,
-                                  match_id=handle.channel.name))
+    legacy_format = 'bo3'
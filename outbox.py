@@ -0,0 +1,139 @@
+# The MIT License (MIT)
+# Copyright (c) 2017 Levak Borok <levak92@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import discord
+import asyncio
+
+from log import get_log
+
+log = get_log(__name__)
+
+# Discord refuses messages longer than this
+MESSAGE_LIMIT = 2000
+
+# Split `msg` in parts fitting in one post, on line breaks when possible
+def split_message(msg, limit=MESSAGE_LIMIT):
+    parts = []
+    while len(msg) > limit:
+        cut = msg.rfind('\n', 0, limit + 1)
+        if cut > 0:
+            parts.append(msg[:cut])
+            msg = msg[cut + 1:]
+        else:
+            parts.append(msg[:limit])
+            msg = msg[limit:]
+    parts.append(msg)
+    return parts
+
+### Per-channel output buffer
+#
+# Messages queued for the same channel within `window` seconds are merged
+# into as few posts as possible, without going over the Discord message
+# limit, longer messages are split. Queuing does not wait for the post: the
+# returned future resolves to the message the text (or its last part) ended
+# up in, or fails if any part could not be posted. Failures are logged
+# whether or not the future is awaited. Posts keep the queuing order.
+# Posts are interactive calls of the FairScheduler, if any.
+class Outbox:
+    RETRIES = 3
+    RETRY_DELAY = 10
+
+    def __init__(self, client, window=0.5, scheduler=None):
+        self.client = client
+        self.scheduler = scheduler
+        self.window = window
+        self.buffers = {}
+        self.locks = {}
+        self.posts = 0
+        self.messages = 0
+
+    def pending(self):
+        return sum(len(buf) for buf in self.buffers.values())
+
+    def send(self, channel, msg):
+        self.messages += 1
+        future = asyncio.Future()
+
+        # Failures are already reported by flush, nobody has to retrieve them
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+
+        if channel.id not in self.buffers:
+            self.buffers[channel.id] = []
+            loop = asyncio.get_event_loop()
+            loop.call_later(max(0, self.window),
+                            lambda: asyncio.ensure_future(self.flush(channel)))
+
+        self.buffers[channel.id].append((msg, future))
+        return future
+
+    async def flush(self, channel):
+        if channel.id not in self.locks:
+            self.locks[channel.id] = asyncio.Lock()
+
+        # Keep posts in order even if a flush is slower than the window
+        async with self.locks[channel.id]:
+            pending = self.buffers.pop(channel.id, [])
+
+            for text, futures in self.pack(pending):
+                try:
+                    message = await self.post(channel, text)
+                except Exception as e:
+                    log.warning('Failed to send message in "{}": {}'\
+                                .format(channel.name, e),
+                                server=getattr(channel, 'server', None), action='send')
+                    for future, last in futures:
+                        if not future.done():
+                            future.set_exception(e)
+                else:
+                    for future, last in futures:
+                        if last and not future.done():
+                            future.set_result(message)
+
+    # Pack messages in order into chunks fitting in one post, as (text,
+    # [ (future, whether the chunk holds the last part of its message) ])
+    def pack(self, pending):
+        chunks = []
+        for msg, future in pending:
+            parts = split_message(msg)
+            for i, part in enumerate(parts):
+                entry = (future, i + 1 == len(parts))
+                if chunks and len(chunks[-1][0]) + 1 + len(part) <= MESSAGE_LIMIT:
+                    chunks[-1] = (chunks[-1][0] + '\n' + part, chunks[-1][1] + [ entry ])
+                else:
+                    chunks.append((part, [ entry ]))
+        return chunks
+
+    async def post(self, channel, text):
+        for retry in range(self.RETRIES):
+            try:
+                self.posts += 1
+                if not self.scheduler:
+                    return await self.client.send_message(channel, text)
+
+                server = getattr(channel, 'server', None)
+                async with self.scheduler.slot(server.id if server else None):
+                    return await self.client.send_message(channel, text)
+            except discord.errors.HTTPException as e:
+                if retry + 1 >= self.RETRIES:
+                    raise
+                log.warning('HTTPexception: {}'.format(str(e)),
+                            server=getattr(channel, 'server', None), action='send')
+                await asyncio.sleep(self.RETRY_DELAY)
@@ -0,0 +1,88 @@
+# The MIT License (MIT)
+# Copyright (c) 2017 Levak Borok <levak92@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+ADMIN = 1
+REFEREE = 2
+STREAMER = 4
+
+### Permissions of a member
+#
+# `mask` is a bitmask of ADMIN, REFEREE and STREAMER, `matches` the names of
+# the match rooms where the member is a team captain.
+class MemberPermissions:
+    __slots__ = ( 'mask', 'matches' )
+
+    def __init__(self, mask, matches):
+        self.mask = mask
+        self.matches = matches
+
+    @property
+    def is_admin(self):
+        return bool(self.mask & ADMIN)
+
+    # Admins have every referee and streamer right
+    @property
+    def is_ref(self):
+        return bool(self.mask & (ADMIN | REFEREE))
+
+    @property
+    def is_streamer(self):
+        return bool(self.mask & (ADMIN | STREAMER))
+
+    def is_captain_in(self, channel_name):
+        return channel_name in self.matches
+
+### Cache of member permissions, by (server ID, member ID)
+#
+# Entries are computed on first use and dropped when the member, a role of
+# the server or the live matches change.
+class PermissionCache:
+    def __init__(self, compute):
+        self.compute = compute
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, member):
+        key = (member.server.id, member.id)
+        entry = self.entries.get(key)
+
+        if entry is None:
+            self.misses += 1
+            entry = self.entries[key] = self.compute(member)
+        else:
+            self.hits += 1
+
+        return entry
+
+    def invalidate_member(self, member):
+        self.entries.pop((member.server.id, member.id), None)
+
+    def invalidate_server(self, server_id):
+        for key in [ k for k in self.entries if k[0] == server_id ]:
+            del self.entries[key]
+
+    def clear(self):
+        self.entries.clear()
@@ -0,0 +1,85 @@
+# The MIT License (MIT)
+# Copyright (c) 2017 Levak Borok <levak92@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import time
+
+from log import get_log
+
+log = get_log(__name__)
+
+### Progress report of a long operation, as one message edited in place
+#
+# Edits are throttled to one every `interval` seconds and skipped while a
+# previous edit is still in flight, so workers can report after every item.
+class Progress:
+    def __init__(self, client, channel, title, total, interval=2.0):
+        self.client = client
+        self.channel = channel
+        self.title = title
+        self.total = total
+        self.interval = interval
+        self.message = None
+        self.editing = False
+        self.last = 0
+
+    def text(self, done, failed, finished=False):
+        return '{icon} {title}: {done}/{total}{failed}'\
+            .format(icon=':white_check_mark:' if finished else ':hourglass_flowing_sand:',
+                    title=self.title,
+                    done=done,
+                    total=self.total,
+                    failed=' ({} failed)'.format(failed) if failed else '')
+
+    async def start(self, done=0, failed=0):
+        if not self.channel:
+            return
+
+        try:
+            self.message = await self.client.send_message(self.channel,
+                                                          self.text(done, failed))
+            self.last = time.time()
+        except:
+            log.warning('No permission to write in "{}"'.format(self.channel.name),
+                        server=self.channel.server, action='progress')
+            self.channel = None
+
+    async def update(self, done, failed):
+        if not self.message or self.editing or time.time() - self.last < self.interval:
+            return
+
+        await self.edit(self.text(done, failed))
+
+    async def finish(self, done, failed):
+        if not self.message:
+            return
+
+        await self.edit(self.text(done, failed, finished=True))
+
+    async def edit(self, text):
+        self.editing = True
+        try:
+            self.message = await self.client.edit_message(self.message, text)
+        except:
+            log.warning('Failed to update progress in "{}"'.format(self.channel.name),
+                        server=self.channel.server, action='progress')
+        finally:
+            self.last = time.time()
+            self.editing = False
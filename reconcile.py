@@ -0,0 +1,140 @@
+# The MIT License (MIT)
+# Copyright (c) 2017 Levak Borok <levak92@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import discord
+
+from log import get_log
+
+log = get_log(__name__)
+
+### Changes needed to bring a member to its desired state
+#
+# - `create`: names of team roles that do not exist yet;
+# - `roles`: existing roles the member is missing;
+# - `nick`: nickname to set, None if already right;
+# - `failed`: changes apply_plan could not make.
+class MemberPlan:
+    def __init__(self, member, create, roles, nick):
+        self.member = member
+        self.create = create
+        self.roles = roles
+        self.nick = nick
+        self.failed = []
+
+    def is_empty(self):
+        return not self.create and not self.roles and self.nick is None
+
+    # Number of Discord write calls applying the plan takes
+    def calls(self):
+        return len(self.create) + (1 if self.roles or self.nick is not None else 0)
+
+    # Audited state of the member once the plan is applied, see audit.py
+    def state(self):
+        roles = set(r.name for r in self.member.roles if not r.is_everyone) \
+              | set(r.name for r in self.roles)
+        return { 'roles': sorted(roles),
+                 'nick': self.nick if self.nick is not None else self.member.nick }
+
+    def __str__(self):
+        changes = [ 'create role <{}>'.format(name) for name in self.create ]
+        if self.roles:
+            changes.append('add roles {}'.format(', '.join('<{}>'.format(r.name) for r in self.roles)))
+        if self.nick is not None:
+            changes.append('rename to "{}"'.format(self.nick))
+
+        return '{member}: {changes}'\
+            .format(member=self.member,
+                    changes='; '.join(changes) if changes else 'up to date')
+
+# Compare the desired `roles` and `nickname` of `member` to its actual state.
+# A desired role can be given by name when it does not exist yet.
+def plan_member(member, roles, nickname):
+    create = [ r for r in roles if isinstance(r, str) ]
+    missing = [ r for r in roles \
+                if r is not None and not isinstance(r, str) and r not in member.roles ]
+    nick = nickname if member.nick != nickname else None
+
+    return MemberPlan(member, create, missing, nick)
+
+# Returns the role IDs `member` has right now. The member edit replaces the
+# whole role list, building it from the cached `member.roles` would drop the
+# roles added by others (or by another worker) since the cache was updated
+async def fetch_role_ids(client, member):
+    route = discord.http.Route('GET', '/guilds/{guild_id}/members/{member_id}',
+                               guild_id=member.server.id, member_id=member.id)
+    data = await client.http.request(route)
+    return data.get('roles', [])
+
+# Apply `plan` with a single member edit setting both the roles and the
+# nickname, returns the number of write calls made. The current roles are
+# read again just before the edit
+async def apply_plan(client, plan):
+    if not plan.roles and plan.nick is None:
+        return 0
+
+    member = plan.member
+    fields = {}
+
+    if plan.roles:
+        current = await fetch_role_ids(client, member)
+        fields['roles'] = unique_role_ids(current + [ r.id for r in plan.roles ])
+    if plan.nick is not None:
+        fields['nick'] = plan.nick
+
+    try:
+        await client.http.edit_member(member.server.id, member.id, **fields)
+        calls = 1
+    except discord.Forbidden:
+        if 'nick' not in fields:
+            raise
+
+        # Members above the bot cannot be renamed, still assign the roles
+        log.warning('Failed to rename "{id}" to "{nick}"'\
+                    .format(id=member, nick=plan.nick),
+                    server=member.server, member=member, action='rename')
+        del fields['nick']
+        plan.failed.append('forbidden to rename to "{}"'.format(plan.nick))
+        plan.nick = None
+        calls = 1
+        if not fields:
+            return calls
+
+        await client.http.edit_member(member.server.id, member.id, **fields)
+        calls += 1
+
+    if 'roles' in fields:
+        log.info('Assigned roles {roles} to "{id}"'\
+                 .format(roles=', '.join('<{}>'.format(r.name) for r in plan.roles),
+                         id=member),
+                 server=member.server, member=member, action='add_roles')
+    if 'nick' in fields:
+        log.info('Renamed "{id}" to "{nick}"'\
+                 .format(id=member, nick=plan.nick),
+                 server=member.server, member=member, action='rename')
+
+    return calls
+
+def unique_role_ids(role_ids):
+    ids = []
+    for role_id in role_ids:
+        if role_id not in ids:
+            ids.append(role_id)
+    return ids
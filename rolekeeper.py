@@ -21,75 +21,114 @@
 
 import discord
 import asyncio
+import aiohttp
 import csv
 import random
 import io
+import time
+import json
+import os
 
-from team import Team, TeamCaptain
-from match import Match, MatchBo2, MatchBo3
+from team import Team, TeamCaptain, RoleRef, role_ref
+from match import Match
+from formats import compile_formats
 from inputs import sanitize_input, translit_input
-from db import open_db
-
-welcome_message_bo1 =\
-"""
-Welcome {m_teamA} and {m_teamB}!
--- Match **BEST OF 1** --
-This text channel will be used by the judge and team captains to exchange anything about the match between teams {teamA} and {teamB}.
-This sequence is made using the `!ban` command team by team until one remains.
-Last team to ban also needs to chose the side they will play on using `!side xxxx` (attack or defend).
-
-For instance, team A types `!ban Pyramid` which will then ban the map _Pyramid_ from the match, team B types `!ban d17` which will ban the map D-17, and so on, until only one map remains. team B then picks the side using `!side attack`.
-"""
-
-welcome_message_bo2 =\
-"""
-Welcome {m_teamA} and {m_teamB}!
--- Match **BEST OF 2** --
-This text channel will be used by the judge and team captains to exchange anything about the match between teams {teamA} and {teamB}.
-This sequence is made using the `!pick`, `!ban` and `!side` commands one by one using the following order:
-
- - {teamA} bans, {teamB} bans,
- - {teamA} picks, {teamB} picks,
- - {teamB} picks the side (attack or defend).
-
-For instance, team A types `!ban Yard` which will then ban the map _Yard_ from the match, team B types `!ban d17` which will ban the map D-17. team A would then type `!pick Destination`, picking the first map and so on, until only one map remains, which will be the tie-breaker map. team B then picks the side using `!side attack`.
-"""
-
-welcome_message_bo3 =\
-"""
-Welcome {m_teamA} and {m_teamB}!
--- Match **BEST OF 3** --
-This text channel will be used by the judge and team captains to exchange anything about the match between teams {teamA} and {teamB}.
-This sequence is made using the `!pick`, `!ban` and `!side` commands one by one using the following order:
-
- - {teamA} bans, {teamB} bans,
- - {teamA} picks, {teamB} picks,
- - {teamA} bans, {teamB} bans,
- - Last map remaining is the draw map,
- - {teamB} picks the side (attack or defend).
-
-For instance, team A types `!ban Yard` which will then ban the map _Yard_ from the match, team B types `!ban d17` which will ban the map D-17. team A would then type `!pick Destination`, picking the first map and so on, until only one map remains, which will be the tie-breaker map. team B then picks the side using `!side attack`.
-"""
+from db import open_db, db_file
+from archive import Archive
+from audit import AuditLog, audit_actor, audit_target, message_actor, member_state
+from api import Api
+from events import EventBus
+from stats import MapStats
+from snapshot import snapshot_lines, write_snapshot, read_snapshot, restore_tables, TABLES
+from reconcile import plan_member, apply_plan
+from joinqueue import JoinQueue
+from scheduler import FairScheduler
+from timers import Timers
+from mailboxes import Mailboxes
+from outbox import Outbox
+from digest import Digests
+from channels import ChannelIndex
+from search import TeamIndex
+from perms import PermissionCache, MemberPermissions, ADMIN, REFEREE, STREAMER
+from roles import RoleIndex, role_id
+from progress import Progress
+from log import get_log
 
 import atexit
 
+log = get_log(__name__)
+
 class RoleKeeper:
-    def __init__(self, client, config):
+    def __init__(self, client, config, config_path=None):
         self.client = client
         self.config = config
+        self.config_path = config_path
+        self.config_mtime = os.path.getmtime(config_path) if config_path else None
         self.db = {}
+        self.api = None
+        self.archives = {}
+        self.teardowns = set()
+        self.refreshes = set()
+        self.audits = {}
+        self.formats = {}
+        self.channels = {}
+        self.role_cache = {}
+        self.team_indexes = {}
+        self.next_provision = {}
+        self.permissions = PermissionCache(self.compute_permissions)
+        self.last_checkpoint = {}
+        self.ready = False
+        self.starting = False
+        self.timers = Timers()
+        self.mailboxes = Mailboxes()
+        self.scheduler = FairScheduler(config.get('discord_concurrency', 8),
+                                       config.get('interactive_reserve', 2))
+        self.outbox = Outbox(client, config.get('coalesce_window', 0.5), self.scheduler)
+        self.digests = Digests(self.timers, self.outbox)
+        self.events = EventBus(config.get('events_history', 1000))
+        self.joins = JoinQueue(self.handle_queued_join,
+                               config.get('join_workers', 2),
+                               config.get('join_rate', 2.0))
         atexit.register(self.atexit)
 
+        self.compile_formats()
+
     def atexit(self):
         if self.db:
             for server, db in self.db.items():
-                print ('Closing DB "{}"'.format(server.name))
+                log.info('Closing DB "{}"'.format(server.name))
                 db.close()
             self.db = None
 
+    # Compile the pick & ban formats once, and check every server map pool
+    # fits them
+    def compile_formats(self):
+        self.format_errors = []
+        self.formats = compile_formats(self.config, self.format_errors)
+
+        for server_name, server_config in self.config['servers'].items():
+            for name, format in sorted(self.formats.items()):
+                error = format.check_pool(server_config['maps'])
+                if error:
+                    log.warning('Format "{}" unavailable in "{}": {}'\
+                                .format(name, server_name, error))
+
+    # Mark the state of a server as changed, API snapshots get rebuilt on
+    # their next request
+    def touch(self, server):
+        self.team_indexes.pop(server.id, None)
+
+        if self.api:
+            self.api.touch(self.config['servers'][server.name]['db'])
+
+    # Publish a pick & ban event of match `match_id` to the event stream
+    # subscribers, see EventBus
+    def publish(self, server, match_id, type, data):
+        self.events.publish(self.config['servers'][server.name]['db'], match_id, type, data)
+
     def check_server(self, server):
         if server.name not in self.config['servers']:
-            print ('WARNING: Server "{}" not configured!'.format(server.name))
+            log.warning('Server "{}" not configured!'.format(server.name))
             return False
         return True
 
@@ -119,23 +158,37 @@ class RoleKeeper:
                 if group_id not in groups:
                     group_name = self.config['roles']['group'].format(group_id) # TODO cup
                     group = discord.utils.get(server.roles, name=group_name)
-                    print('{id}: {g}'.format(id=group_id, g=group))
-                    groups[group_id] = group
+                    log.debug('{id}: {g}'.format(id=group_id, g=group),
+                              server=server, action='parse_teams')
+                    groups[group_id] = group.id if group else None
                     self.cache_role(server, group_name)
 
-        print('Parsed teams:')
-        # Print parsed members
+        log.info('Parsed {} team captain(s)'.format(len(captains)),
+                 server=server, action='parse_teams')
         for m in captains:
-            print('-> {}'.format(captains[m]))
+            log.debug('-> {}'.format(captains[m]),
+                      server=server, member=m, action='parse_teams')
 
         self.db[server]['captains'] = captains # TODO Add cup
         self.db[server]['groups'] = groups # TODO cup/ref?
 
-    def open_db(self, server):
+    # Open the server DB without blocking the event loop, shelve/dbm
+    # opening is synchronous and can be slow on big DB files
+    async def open_db(self, server):
         if server in self.db and self.db[server]:
             self.db[server].close()
 
-        self.db[server] = open_db(self.config['servers'][server.name]['db'])
+        loop = asyncio.get_event_loop()
+        db = await loop.run_in_executor(None,
+                                        open_db,
+                                        self.config['servers'][server.name]['db'])
+
+        if db is None:
+            log.error('No DB for server "{}"'.format(server.name))
+            self.db.pop(server, None)
+            return
+
+        self.db[server] = db
 
         if 'matches' not in self.db[server]:
             self.db[server]['matches'] = {}
@@ -155,29 +208,322 @@ class RoleKeeper:
         if 'sroles' not in self.db[server]:
             self.db[server]['sroles'] = {}
 
-        # Refill group cache
+        # Pick & ban statistics per format, see MapStats
+        if 'stats' not in self.db[server]:
+            self.db[server]['stats'] = {}
+
+        # Matches registered with !schedule, by room name
+        if 'schedule' not in self.db[server]:
+            self.db[server]['schedule'] = {}
+
+        # Every match room ever created, including finished matches
+        if 'rooms' not in self.db[server]:
+            self.db[server]['rooms'] = set(self.db[server]['matches'].keys())
+
+        self.archives[server.id] = \
+            Archive(db_file(self.config['servers'][server.name]['db'], '.archive.jsonl.gz'))
+
+        audit_config = self.config.get('audit', {})
+        self.audits[server.id] = \
+            AuditLog(db_file(self.config['servers'][server.name]['db'], '.audit.jsonl.gz'),
+                     audit_config.get('max_bytes', 10 * 1024 * 1024),
+                     audit_config.get('backup_count', 5))
+
+        self.migrate_ids(server)
+        self.resume_server(server)
+
+        # Resume a teardown interrupted by a restart, not one that stopped on
+        # failed items
+        if self.db[server].get('teardown') and not self.db[server]['teardown'].get('stopped'):
+            log.info('Resuming wipe of {} in "{}"'\
+                     .format(self.db[server]['teardown']['kind'], server.name))
+            asyncio.ensure_future(self.run_teardown(server))
+
+    # Bring the caches and timers in line with a freshly loaded server DB
+    def resume_server(self, server):
+        self.rebind_role_ids(server)
+        self.revalidate_caches(server)
+        self.permissions.invalidate_server(server.id)
+        self.touch(server)
+
+        if self.api:
+            self.api.touch(None)
+
+        # Re-arm persisted turn deadlines
+        for channel_name, match in self.db[server]['matches'].items():
+            self.arm_deadline(server, channel_name, match)
+
+        # Re-arm scheduled matches
+        for channel_name, entry in self.db[server]['schedule'].items():
+            self.arm_schedule(server, channel_name, entry)
+
+    # Team role IDs that do not exist on the server, because the DB comes
+    # from a snapshot of another server or the roles were recreated, are
+    # looked up again by role name, in the team table, captains, matches and
+    # scheduled matches
+    def rebind_role_ids(self, server):
+        db = self.db[server]
+        ids = set(r.id for r in server.roles)
+        by_name = { r.name: r.id for r in server.roles }
+
+        names = { team.role_id: role_name for role_name, team in db['teams'].items() }
+        for match in db['matches'].values():
+            for team in match.teams:
+                names.setdefault(team.id, team.name)
+
+        mapping = { old: by_name[name] for old, name in names.items() \
+                    if old is not None and old not in ids and name in by_name }
+        if not mapping:
+            return
+
+        for team in db['teams'].values():
+            team.role_id = mapping.get(team.role_id, team.role_id)
+
+        for captain in db['captains'].values():
+            captain.team_id = mapping.get(captain.team_id, captain.team_id)
+
+        for match in db['matches'].values():
+            match.teamA = RoleRef(mapping.get(match.teamA.id, match.teamA.id), match.teamA.name)
+            match.teamB = RoleRef(mapping.get(match.teamB.id, match.teamB.id), match.teamB.name)
+            match.teams = [ match.teamA, match.teamB ]
+
+        for entry in db['schedule'].values():
+            entry['teams'] = [ mapping.get(role_id, role_id) for role_id in entry['teams'] ]
+
+        log.info('Rebound {} team role ID(s) by name'.format(len(mapping)),
+                 server=server, action='rebind_roles')
+
+    # DBs written by older versions hold pickled Discord objects, convert
+    # them to the role IDs stored now
+    def migrate_ids(self, server):
+        db = self.db[server]
+
+        for key in ('groups', 'roles', 'sroles'):
+            if any(v is not None and not isinstance(v, str) for v in db[key].values()):
+                db[key] = { k: role_id(v) for k, v in db[key].items() }
+
+        for team in db['teams'].values():
+            if 'role' in team.__dict__:
+                team.role_id = role_id(team.__dict__.pop('role'))
+
+        for captain in db['captains'].values():
+            if 'team_id' not in captain.__dict__:
+                captain.team_id = role_id(captain.__dict__.pop('team', None))
+
+        for match in db['matches'].values():
+            match.teamA = role_ref(match.teamA)
+            match.teamB = role_ref(match.teamB)
+            match.teams = [ match.teamA, match.teamB ]
+
+    # Refresh every cached Discord role ID against the current server state,
+    # roles may have been renamed or recreated while we were away
+    def revalidate_caches(self, server):
+        self.channels[server.id] = ChannelIndex(server)
+        self.role_cache[server.id] = RoleIndex(server)
+        self.cache_roles(server)
+
+    # Refill the special role, group and team role caches from their names
+    def cache_roles(self, server):
         self.db[server]['sroles'] = {}
         self.cache_special_role(server, 'captain')
         self.cache_special_role(server, 'referee')
         self.cache_special_role(server, 'streamer')
 
+        for role_name in list(self.db[server]['roles'].keys()):
+            self.cache_role(server, role_name)
+
+        for group_id in list(self.db[server]['groups'].keys()):
+            group_name = self.config['roles']['group'].format(group_id)
+            self.db[server]['groups'][group_id] = \
+                role_id(discord.utils.get(server.roles, name=group_name))
+
+        for role_name, team in self.db[server]['teams'].items():
+            role = discord.utils.get(server.roles, name=role_name)
+            if role:
+                team.role_id = role.id
+
     # Acknowledgement that we are succesfully connected to Discord
+    # 1. On first connection, open all server DBs concurrently
+    # 2. On reconnection, Discord fires this event again: keep the opened
+    #    DBs and only revalidate caches against the current server state.
+    #    This includes a reconnection while the first connection is still
+    #    opening the DBs, those not opened yet are left to it
     async def on_ready(self):
+        servers = []
 
         for server in self.client.servers:
-            print('Server: {}'.format(server))
+            log.info('Server: {}'.format(server))
 
             if self.check_server(server):
-                self.open_db(server)
+                servers.append(server)
+
+        if self.ready or self.starting:
+            log.info('Reconnected, revalidating caches')
+            for server in servers:
+                if server in self.db:
+                    self.revalidate_caches(server)
+                elif self.ready:
+                    await self.open_db(server)
+            return
+
+        self.starting = True
+        self.timers.start()
+        await asyncio.gather(*[ self.open_db(server) for server in servers ])
+        self.joins.start()
+        self.watch_config()
+
+        if 'api' in self.config:
+            self.api = Api(self, **self.config['api'])
+            try:
+                await self.api.start()
+            except Exception as e:
+                log.error('Cannot start API: {}'.format(e))
+
+        self.ready = True
+        self.starting = False
+
+    # Top-level configuration keys only read at startup
+    RESTART_KEYS = ( 'app_bot_token', 'api', 'logging', 'audit', 'events_history', 'join_workers' )
+
+    # Re-read the configuration file and apply it, reporting what changed in
+    # `channel`. The running configuration is kept if the file is invalid
+    async def reload_config(self, channel=None):
+        def report(msg):
+            if channel:
+                self.outbox.send(channel, msg)
+
+        if not self.config_path:
+            report('No configuration file to reload')
+            return
+
+        def read():
+            mtime = os.path.getmtime(self.config_path)
+            with open(self.config_path, 'r') as f:
+                return mtime, json.load(f)
+
+        loop = asyncio.get_event_loop()
+        try:
+            # The watcher must not reload this version again
+            self.config_mtime, config = await loop.run_in_executor(None, read)
+        except Exception as e:
+            log.error('Cannot reload configuration: {}'.format(e), action='reload')
+            report(':warning: Cannot reload configuration: `{}`'.format(e))
+            return
+
+        changed, restart = self.apply_config(config)
+
+        if 'watch_config' in changed:
+            self.watch_config()
+
+        log.info('Reloaded configuration: {} changed{}'\
+                 .format(', '.join(changed) or 'nothing',
+                         ', restart needed for ' + ', '.join(restart) if restart else ''),
+                 action='reload')
+
+        report(':arrows_counterclockwise: Configuration reloaded: {}'.format(', '.join(changed) or 'nothing changed'))
+        if 'formats' in changed and self.format_errors:
+            report(':warning: Rejected formats:\n{}'\
+                   .format('\n'.join(' - {}'.format(e) for e in self.format_errors)))
+        if restart:
+            report(':warning: Restart needed to apply: {}'.format(', '.join(restart)))
+
+    # Swap in `config` and only rebuild the state derived from what changed.
+    # Broadcast rooms, digests and deadlines are read from the configuration
+    # on use and need no rebuild. Matches in progress keep their map pool.
+    # Returns the changed parts and the ones needing a restart
+    def apply_config(self, config):
+        old = self.config
+        changed = []
+        restart = [ key for key in self.RESTART_KEYS if old.get(key) != config.get(key) ]
 
-            #await self.refresh(server)
+        old_servers = old.get('servers', {})
+        new_servers = config.get('servers', {})
+
+        for name in sorted(set(old_servers) | set(new_servers)):
+            if name not in old_servers or name not in new_servers \
+               or old_servers[name].get('db') != new_servers[name].get('db'):
+                restart.append('servers/{}'.format(name))
+
+        self.config = config
+
+        # 1. Pick & ban formats, checked against every map pool
+        maps_changed = [ name for name in new_servers \
+                         if name in old_servers \
+                         and old_servers[name].get('maps') != new_servers[name].get('maps') ]
+
+        if old.get('formats') != config.get('formats') or maps_changed:
+            self.compile_formats()
+            changed.append('formats')
+        changed += [ 'servers/{}/maps'.format(name) for name in maps_changed ]
+
+        # 2. Special, group and team role caches
+        if old.get('roles') != config.get('roles'):
+            for server in self.db:
+                self.cache_roles(server)
+                self.touch(server)
+            self.permissions.clear()
+            changed.append('roles')
+
+        # 3. Everything else is read on use
+        for name in sorted(new_servers):
+            if name not in old_servers:
+                continue
+            for key in sorted(set(old_servers[name]) | set(new_servers[name])):
+                if key not in ('maps', 'db') \
+                   and old_servers[name].get(key) != new_servers[name].get(key):
+                    changed.append('servers/{}/{}'.format(name, key))
+
+        if old.get('coalesce_window') != config.get('coalesce_window'):
+            self.outbox.window = config.get('coalesce_window', 0.5)
+            changed.append('coalesce_window')
+
+        if old.get('join_rate') != config.get('join_rate'):
+            rate = config.get('join_rate', 2.0)
+            self.joins.interval = 1.0 / rate if rate else 0
+            changed.append('join_rate')
+
+        if old.get('discord_concurrency') != config.get('discord_concurrency') \
+           or old.get('interactive_reserve') != config.get('interactive_reserve'):
+            self.scheduler.resize(config.get('discord_concurrency', 8),
+                                  config.get('interactive_reserve', 2))
+            changed.append('discord_concurrency')
+
+        for key in ('teardown_concurrency', 'provision_interval', 'watch_config'):
+            if old.get(key) != config.get(key):
+                changed.append(key)
+
+        return changed, restart
+
+    # Poll the configuration file every `watch_config` seconds, and reload
+    # it when it changes
+    def watch_config(self):
+        interval = self.config.get('watch_config')
+
+        if not interval or not self.config_path:
+            self.timers.cancel(('config',))
+            return
+
+        self.timers.schedule(('config',), time.time() + interval, self.check_config)
+
+    async def check_config(self):
+        try:
+            loop = asyncio.get_event_loop()
+            mtime = await loop.run_in_executor(None, os.path.getmtime, self.config_path)
+
+            if mtime != self.config_mtime:
+                self.config_mtime = mtime
+                await self.reload_config()
+        except OSError as e:
+            log.warning('Cannot watch configuration: {}'.format(e), action='reload')
+        finally:
+            self.watch_config()
 
     async def on_dm(self, message):
         # If it is us sending the DM, exit
         if message.author == self.client.user:
             return
 
-        print('PM from {}: {}'.format(message.author, message.content))
+        log.info('PM from {}: {}'.format(message.author, message.content))
 
         # Apologize
         await self.reply(message,
@@ -189,31 +535,96 @@ class RoleKeeper:
         if member.server.name not in self.config['servers']:
             return
 
-        await self.handle_member_join(member)
+        # Joins come in storms when registrations open, queue them
+        self.joins.put(member)
+
+    # Keep the channel index of the server current
+    def on_channel_create(self, channel):
+        if not channel.is_private and channel.server.id in self.channels:
+            self.channels[channel.server.id].add(channel)
+
+    def on_channel_delete(self, channel):
+        if not channel.is_private and channel.server.id in self.channels:
+            self.channels[channel.server.id].remove(channel)
+
+    def on_channel_update(self, before, after):
+        if not after.is_private and after.server.id in self.channels:
+            self.channels[after.server.id].update(before, after)
+
+    # Find a channel of a server by name or by ID, through the index
+    def get_channel(self, server, name=None, id=None):
+        if server.id not in self.channels:
+            self.channels[server.id] = ChannelIndex(server)
+        return self.channels[server.id].get(name=name, id=id)
 
     def cache_special_role(self, server, role_id):
         role_name = self.config['roles'][role_id]
         role = discord.utils.get(server.roles, name=role_name)
-        self.db[server]['sroles'][role_id] = role
-        if not self.db[server]['sroles'][role_id]:
-            print ('WARNING: Missing role "{}" in {}'.format(role_name, server.name))
+        self.db[server]['sroles'][role_id] = role.id if role else None
+        if not role:
+            log.warning('Missing role "{}" in {}'.format(role_name, server.name))
 
     def get_special_role(self, server, role_id):
         if role_id in self.db[server]['sroles']:
-            return self.db[server]['sroles'][role_id]
+            return self.resolve_role(server, self.db[server]['sroles'][role_id])
         return None
 
     def cache_role(self, server, role_id):
         role = discord.utils.get(server.roles, name=role_id)
-        self.db[server]['roles'][role_id] = role
-        if not self.db[server]['roles'][role_id]:
-            print ('WARNING: Missing role "{}" in {}'.format(role_id, server.name))
+        self.db[server]['roles'][role_id] = role.id if role else None
+        if not role:
+            log.warning('Missing role "{}" in {}'.format(role_id, server.name))
 
     def get_role(self, server, role_id):
         if role_id in self.db[server]['roles']:
-            return self.db[server]['roles'][role_id]
+            return self.resolve_role(server, self.db[server]['roles'][role_id])
         return None
 
+    def get_group_role(self, server, group_id):
+        return self.resolve_role(server, self.db[server]['groups'].get(group_id))
+
+    # Returns the live role of ID `role_id`, or None
+    def resolve_role(self, server, role_id):
+        if server.id not in self.role_cache:
+            self.role_cache[server.id] = RoleIndex(server)
+        return self.role_cache[server.id].get(role_id)
+
+    # Keep the role index and the member permissions of the server current
+    def on_server_role_change(self, role):
+        if role.server.id in self.role_cache:
+            self.role_cache[role.server.id].invalidate()
+        self.permissions.invalidate_server(role.server.id)
+
+    def on_member_update(self, before, after):
+        self.permissions.invalidate_member(after)
+
+    def on_member_remove(self, member):
+        self.permissions.invalidate_member(member)
+
+    # Compute the permissions of a member for on_message, see
+    # PermissionCache
+    def compute_permissions(self, member):
+        mask = 0
+        role_names = set(r.name for r in member.roles)
+
+        if member.server_permissions.manage_roles:
+            mask |= ADMIN
+        if self.config['roles']['referee'] in role_names:
+            mask |= REFEREE
+        if self.config['roles']['streamer'] in role_names:
+            mask |= STREAMER
+
+        matches = frozenset()
+        if member.server in self.db:
+            role_ids = set(r.id for r in member.roles)
+            matches = frozenset(name for name, match in self.db[member.server]['matches'].items() \
+                                if match.teamA.id in role_ids or match.teamB.id in role_ids)
+
+        return MemberPermissions(mask, matches)
+
+    def get_permissions(self, member):
+        return self.permissions.get(member)
+
     async def add_captain(self, message, server, member, team, nick, group): # TODO cup
         if not self.check_server(server):
             return
@@ -234,7 +645,8 @@ class RoleKeeper:
             TeamCaptain(discord_id, team, nick, group)
 
         # Trigger update on member
-        await self.handle_member_join(member)
+        await self.handle_member_join(member, actor=message_actor(message))
+        self.touch(server)
 
     async def remove_captain(self, message, server, member):
         if not self.check_server(server):
@@ -249,182 +661,445 @@ class RoleKeeper:
         captain = self.db[server]['captains'][discord_id]
 
         captain_role = self.get_special_role(server, 'captain') # TODO cup, which cup? not special?
-        group_role = self.db[server]['groups'][captain.group]
-        team_role = captain.team
+        group_role = self.get_group_role(server, captain.group)
+        team_role = self.resolve_role(server, captain.team_id)
 
         crole_name = captain_role.name if captain_role else ''
         grole_name = group_role.name if group_role else ''
         trole_name = team_role.name if team_role else ''
 
+        actor = message_actor(message)
+        before = member_state(member)
+        after = dict(before, roles=[ r for r in before['roles'] \
+                                     if r not in (crole_name, grole_name, trole_name) ])
+
         # Remove team, team captain and group roles from member
         try:
             await self.client.remove_roles(member, captain_role, group_role, team_role)
-            print ('Remove roles "{crole}", "{grole}" and "{trole}" from "{member}"'\
-                   .format(member=discord_id,
-                           crole=crole_name,
-                           grole=grole_name,
-                           trole=trole_name))
-
-            del self.db[server]['teams'][trole_name]
-        except:
-            print ('WARNING: Failed to remove roles "{crole}", "{grole}" and "{trole}" from "{member}"'\
-                   .format(member=discord_id,
-                           crole=crole_name,
-                           grole=grole_name,
-                           trole=trole_name))
+            self.audit(server, actor, 'remove_roles', audit_target('member', member), before, after)
+            log.info('Remove roles "{crole}", "{grole}" and "{trole}" from "{member}"'\
+                     .format(member=discord_id,
+                             crole=crole_name,
+                             grole=grole_name,
+                             trole=trole_name),
+                     server=server, member=discord_id, action='remove_roles')
+
+            self.db[server]['teams'].pop(trole_name, None)
+        except Exception as e:
+            self.audit(server, actor, 'remove_roles', audit_target('member', member), before, after, e)
+            log.warning('Failed to remove roles "{crole}", "{grole}" and "{trole}" from "{member}"'\
+                        .format(member=discord_id,
+                                crole=crole_name,
+                                grole=grole_name,
+                                trole=trole_name),
+                        server=server, member=discord_id, action='remove_roles')
             pass
 
         # Check if the role is now orphan, and delete it
         if not any(r == team_role for m in server.members for r in m.roles):
             try:
                 await self.client.delete_role(server, team_role)
-                print ('Deleted role "{role}"'\
-                       .format(role=trole_name))
-            except:
-                print ('WARNING: Failed to delete role "{role}"'\
-                       .format(role=trole_name))
+                self.audit(server, actor, 'delete_role', audit_target('role', team_role))
+                log.info('Deleted role "{role}"'\
+                         .format(role=trole_name),
+                         server=server, action='delete_role')
+            except Exception as e:
+                if team_role:
+                    self.audit(server, actor, 'delete_role', audit_target('role', team_role), error=e)
+                log.warning('Failed to delete role "{role}"'\
+                            .format(role=trole_name),
+                            server=server, action='delete_role')
                 pass
 
 
         # Reset member nickname
+        nick = member.nick
         try:
             await self.client.change_nickname(member, None)
-            print ('Reset nickname for "{member}"'\
-                   .format(member=discord_id))
-        except:
-            print ('WARNING: Failed to reset nickname for "{member}"'\
-                   .format(member=discord_id))
+            self.audit(server, actor, 'reset_nickname', audit_target('member', member),
+                       { 'nick': nick }, { 'nick': None })
+            log.info('Reset nickname for "{member}"'\
+                     .format(member=discord_id),
+                     server=server, member=discord_id, action='reset_nickname')
+        except Exception as e:
+            self.audit(server, actor, 'reset_nickname', audit_target('member', member),
+                       { 'nick': nick }, { 'nick': None }, e)
+            log.warning('Failed to reset nickname for "{member}"'\
+                        .format(member=discord_id),
+                        server=server, member=discord_id, action='reset_nickname')
             pass
 
         # Remove captain from DB
         del self.db[server]['captains'][discord_id]
+        self.touch(server)
 
     # Refresh internal structures
-    # 1. Reparse team captain file
-    # 2. Refill group cache
-    # 3. Visit all members with no role
-    async def refresh(self, server):
+    # 1. Start a new refresh generation, or resume the unfinished one
+    # 2. Reparse team captain file (new generation only)
+    # 3. Refill group cache
+    # 4. Reconcile all captains of the server, skipping the ones already
+    #    visited in this generation. Only missing roles and nicknames are
+    #    changed, refreshing a server already in sync changes nothing
+    # With `dry_run`, only list the changes a refresh would make. Only one
+    # refresh runs at a time on a server
+    async def refresh(self, server, channel=None, dry_run=False, actor=None):
         if not self.check_server(server):
             return
 
+        if dry_run:
+            await self.refresh_dry_run(server, channel)
+            return
+
+        if server.id in self.refreshes:
+            if channel:
+                self.outbox.send(channel, 'A refresh is already running')
+            return
+
+        self.refreshes.add(server.id)
+
+        try:
+            await self.run_refresh(server, channel, actor)
+        finally:
+            self.refreshes.discard(server.id)
+
+    async def run_refresh(self, server, channel, actor):
         # TODO cups
 
-        # TODO remove, use CSV upload instead
-        # Reparse team captain file
-        self.parse_teams(server, self.config['servers'][server.name]['captains'])
-        await self.create_all_roles(server)
+        # 1. Start a new refresh generation, or resume the unfinished one
+        state = self.db[server].get('refresh')
+        resumed = state is not None and not state['complete']
+
+        if not resumed:
+            state = { 'generation': state['generation'] + 1 if state else 1,
+                      'done': set(),
+                      'complete': False }
+            self.db[server]['refresh'] = state
+
+            # TODO remove, use CSV upload instead
+            # 2. Reparse team captain file
+            self.parse_teams(server, self.config['servers'][server.name]['captains'])
+
+        log.info('{action} refresh #{gen} of "{server}" ({done} member(s) already visited)'\
+                 .format(action='Resuming' if resumed else 'Starting',
+                         gen=state['generation'],
+                         server=server.name,
+                         done=len(state['done'])),
+                 server=server, action='refresh')
+        started = time.time()
+
+        self.checkpoint(server, 'refresh', 'captains', 'groups', force=True)
+
+        actor = actor or audit_actor('!refresh')
+
+        # 3. Refill group cache
+        await self.create_all_roles(server, actor)
+
+        # 4. Reconcile all captains
+        members = [ m for m in self.captain_members(server) \
+                    if m.id not in state['done'] ]
+
+        progress = Progress(self.client, channel,
+                            'Refresh #{}'.format(state['generation']),
+                            len(members))
+        await progress.start()
+
+        calls = 0
+        for i, member in enumerate(members):
+            async with self.scheduler.slot(server.id, bulk=True):
+                plan = await self.handle_member_join(member, actor=actor)
+            calls += plan.calls() if plan else 0
+
+            # Checkpoint the member as visited in this generation, only the
+            # small refresh record is written
+            state['done'].add(member.id)
+            self.checkpoint(server, 'refresh')
+
+            await progress.update(i + 1, 0)
+
+        state['complete'] = True
+        self.touch(server)
+        self.checkpoint(server, 'refresh', 'teams', 'captains', force=True)
+
+        log.info('Refresh #{gen} of "{server}" done: {count} captain(s), {calls} write call(s)'\
+                 .format(gen=state['generation'],
+                         server=server.name,
+                         count=len(members),
+                         calls=calls),
+                 server=server, action='refresh', duration=time.time() - started)
+
+        await progress.finish(len(members), 0)
+
+    # Returns the members of the server that are in the captain list
+    def captain_members(self, server):
+        captains = self.db[server]['captains']
+        return [ m for m in server.members if str(m) in captains ]
+
+    # List the changes a refresh would make, without making any. At most
+    # DRY_RUN_LINES changes are sent in the channel
+    DRY_RUN_LINES = 50
+
+    async def refresh_dry_run(self, server, channel=None):
+        plans = []
+        for member in self.captain_members(server):
+            plan = await self.handle_member_join(member, dry_run=True)
+            if plan and not plan.is_empty():
+                plans.append(plan)
+
+        # Team roles are only created once, even if several captains need them
+        creates = set(name for plan in plans for name in plan.create)
+        calls = len(creates) + sum(plan.calls() - len(plan.create) for plan in plans)
+
+        summary = 'Refresh dry run of "{server}": {count} captain(s) to update, {calls} write call(s)'\
+            .format(server=server.name,
+                    count=len(plans),
+                    calls=calls)
+        lines = [ ' - {}'.format(plan) for plan in plans ]
+
+        log.info(summary, server=server, action='refresh_dry_run')
+        for line in lines:
+            log.info(line, server=server, action='refresh_dry_run')
+
+        if channel:
+            self.outbox.send(channel, summary)
+            for line in lines[:self.DRY_RUN_LINES]:
+                self.outbox.send(channel, line)
+            if len(lines) > self.DRY_RUN_LINES:
+                self.outbox.send(channel, ' - ... and {} more'.format(len(lines) - self.DRY_RUN_LINES))
 
-        # Visit all members with no role
-        for member in server.members:
-            if len(member.roles) == 1:
-                print('- Member without role: {}'.format(member))
-                await self.handle_member_join(member)
 
     # Go through the parsed captain list and create all team roles
     # TODO remove this
-    async def create_all_roles(self, server):
+    async def create_all_roles(self, server, actor=None):
         if not self.check_server(server):
             return
 
         self.db[server]['teams'] = {}
         for _, captain in self.db[server]['captains'].items():
-            role = await self.create_team_role(server, captain.team_name)
-            captain.team = role
+            role = await self.create_team_role(server, captain.team_name, actor)
+            captain.team_id = role_id(role)
 
-    # Create team captain role
-    async def create_team_role(self, server, team_name):
+        self.touch(server)
+
+    # Returns the existing role of a team, or None
+    def get_team_role(self, server, team_name):
         role_name = self.config['roles']['team'].format(team_name)
 
         if role_name in self.db[server]['teams']:
-            return self.db[server]['teams'][role_name].role
+            role = self.resolve_role(server, self.db[server]['teams'][role_name].role_id)
+            if role:
+                return role
 
-        role = discord.utils.get(server.roles, name=role_name)
+        return discord.utils.get(server.roles, name=role_name)
 
-        if not role:
-            role = await self.client.create_role(
-                server,
-                name=role_name,
-                permissions=discord.Permissions.none(),
-                mentionable=True)
+    # Create team captain role
+    async def create_team_role(self, server, team_name, actor=None):
+        role_name = self.config['roles']['team'].format(team_name)
+        role = self.get_team_role(server, team_name)
+
+        if role and role_name in self.db[server]['teams']:
+            return role
 
-            print('Create new role <{role}>'\
-                  .format(role=role_name))
+        if not role:
+            actor = actor or audit_actor('create_team_role')
+            try:
+                role = await self.client.create_role(
+                    server,
+                    name=role_name,
+                    permissions=discord.Permissions.none(),
+                    mentionable=True)
+            except Exception as e:
+                self.audit(server, actor, 'create_role',
+                           { 'type': 'role', 'id': None, 'name': role_name },
+                           after={ 'name': role_name }, error=e)
+                raise
+
+            self.on_server_role_change(role)
+            self.audit(server, actor, 'create_role', audit_target('role', role),
+                       after={ 'name': role_name })
+
+            log.info('Create new role <{role}>'\
+                     .format(role=role_name),
+                     server=server, action='create_role')
 
         role.name = role_name # This is a hotfix
 
-        self.db[server]['teams'][role_name] = Team(team_name, role)
+        self.db[server]['teams'][role_name] = Team(team_name, role.id)
+        self.touch(server)
 
         return role
 
     # Whenever a new member joins into the Discord server
-    # 1. Create a user group just for the Team captain
-    # 2. Assign the special group to that Team captain
-    # 3. Assign the global group to that Team captain
-    # 4. Change nickname of Team captain
-    async def handle_member_join(self, member):
+    # 1. Compare the desired roles and nickname of the Team captain to its
+    #    actual ones
+    # 2. Create the user group just for the Team captain, if missing
+    # 3. Assign the missing team, captain and group roles
+    # 4. Change nickname of Team captain, if different
+    # With `dry_run`, nothing is changed. Returns the MemberPlan, or None if
+    # the member is not a captain
+    async def handle_member_join(self, member, dry_run=False, actor=None):
         discord_id = str(member)
         server = member.server
 
         # TODO find cup from discord_id
 
         if discord_id not in self.db[server]['captains']:
-            print('WARNING: New user "{}" not in captain list'\
-                  .format(discord_id))
-            return
-
-        print('Team captain "{}" joined server'\
-              .format(discord_id))
+            log.warning('New user "{}" not in captain list'\
+                        .format(discord_id),
+                        server=server, member=discord_id, action='member_join')
+            return None
 
         captain = self.db[server]['captains'][discord_id]
 
-        # Create role
-        team_role = await self.create_team_role(server, captain.team_name) # TODO cup
-        captain.team = team_role
-
-        # Assign user roles
-        group_role = self.db[server]['groups'][captain.group]
+        # 1. Compare desired and actual state
+        team_role = self.get_team_role(server, captain.team_name) # TODO cup
+        group_role = self.get_group_role(server, captain.group)
         captain_role = self.get_special_role(server, 'captain') # TODO cup, which cup? not special?
 
-        if team_role and captain_role and group_role:
-            await self.client.add_roles(member, team_role, captain_role, group_role)
-        else:
-            print('ERROR: Missing one role out of R:{} C:{} G:{}'\
-                  .format(team_role, captain_role, group_role))
+        plan = plan_member(member,
+                           [ team_role or self.config['roles']['team'].format(captain.team_name),
+                             captain_role,
+                             group_role ],
+                           captain.nickname)
 
-        print('Assigned role <{role}> to "{id}"'\
-              .format(role=team_role.name, id=discord_id))
+        if dry_run:
+            return plan
 
-        # Change nickname of team captain
-        nickname = '{}'.format(captain.nickname)
+        actor = actor or audit_actor('member_join')
 
+        # 2. Create role
+        if plan.create:
+            team_role = await self.create_team_role(server, captain.team_name, actor) # TODO cup
+            plan.roles.append(team_role)
+        captain.team_id = role_id(team_role)
+
+        if plan.is_empty():
+            return plan
+
+        log.info('Team captain "{}" joined server'\
+                 .format(discord_id),
+                 server=server, member=discord_id, action='member_join')
+
+        # 3. and 4. Assign user roles and nickname
+        if not (team_role and captain_role and group_role):
+            log.error('Missing one role out of R:{} C:{} G:{}'\
+                      .format(team_role, captain_role, group_role),
+                      server=server, member=discord_id, action='member_join')
+            plan.roles = []
+
+        before = member_state(member)
         try:
-            await self.client.change_nickname(member, nickname)
-            print ('Renamed "{id}" to "{nick}"'\
-                   .format(id=discord_id, nick=nickname))
-        except:
-            print ('WARNING: Failed to rename "{id}" to "{nick}"'\
-                   .format(id=discord_id, nick=nickname))
-            pass
+            await apply_plan(self.client, plan)
+        except Exception as e:
+            self.audit(server, actor, 'edit_member', audit_target('member', member),
+                       before, plan.state(), e)
+            raise
+
+        self.audit(server, actor, 'edit_member', audit_target('member', member),
+                   before, plan.state(), '; '.join(plan.failed) or None)
+
+        return plan
+
+    # Members queued by on_member_join, a join storm is bulk work
+    async def handle_queued_join(self, member):
+        async with self.scheduler.slot(member.server.id, bulk=True):
+            return await self.handle_member_join(member)
 
     # Reply to a message in a channel
     async def reply(self, message, reply):
-        return await self.client.send_message(
-            message.channel,
-            '{} {}'.format(message.author.mention, reply))
+        async with self.scheduler.slot(message.server.id if message.server else None):
+            return await self.client.send_message(
+                message.channel,
+                '{} {}'.format(message.author.mention, reply))
+
+    # Returns the role names of the teams matching `query`, see TeamIndex
+    def find_teams(self, server, query):
+        if server.id not in self.team_indexes:
+            self.team_indexes[server.id] = TeamIndex(self.db[server]['teams'])
+        return self.team_indexes[server.id].find(query)
+
+    # Returns the role of the team matching `query`, or replies with the
+    # teams it could be and returns None
+    async def find_team_role(self, message, server, query):
+        found = self.find_teams(server, query)
+
+        if len(found) > 1:
+            await self.reply(message, 'Which team for "{}"? {}'\
+                             .format(query, ', '.join('`{}`'.format(self.db[server]['teams'][n].name) \
+                                                      for n in found)))
+            return None
+
+        role = self.get_team_role(server, self.db[server]['teams'][found[0]].name) \
+               if found else None
+
+        if not role:
+            await self.reply(message, 'No team named "{}"'.format(query))
+
+        return role
+
+    # Create a match against 2 teams given by name instead of role mention,
+    # scheduled at timestamp `start` if given
+    async def matchup_by_name(self, message, server, teamA, teamB, mode='bo1', start=None):
+        if not self.check_server(server):
+            return
 
-    MATCH_BO1 = 1
-    MATCH_BO2 = 2
-    MATCH_BO3 = 3
+        roleA = await self.find_team_role(message, server, teamA)
+        if not roleA:
+            return
+
+        roleB = await self.find_team_role(message, server, teamB)
+        if not roleB:
+            return
+
+        if start is None:
+            await self.matchup(message, server, roleA, roleB, mode=mode)
+        else:
+            await self.schedule_match(message, server, roleA, roleB, mode, start)
 
     # Create a match against 2 teams
-    # 1. Create the text channel
+    # 1. Create the text channel, see provision_room
     # 2. Add permissions to read/send to both teams, and the judge
-    # 3. Send welcome message
+    # 3. Send welcome message, see start_match
     # 4. Register the match to internal logic for commands like !ban x !pick x
-    async def matchup(self, message, server, _roleteamA, _roleteamB, mode=MATCH_BO1): # TODO cup
+    async def matchup(self, message, server, _roleteamA, _roleteamB, mode='bo1'): # TODO cup
         if not self.check_server(server):
             return
 
+        prepared = await self.prepare_match(message, server, _roleteamA, _roleteamB, mode)
+        if not prepared:
+            return
+
+        channel_name, roleteamA, roleteamB = prepared
+
+        if channel_name in self.db[server]['schedule']:
+            await self.reply(message, 'Match `{}` is scheduled, use `!unschedule {}` first'\
+                             .format(channel_name, channel_name))
+            return
+
+        channel = await self.provision_room(server, channel_name, roleteamA, roleteamB,
+                                            message_actor(message))
+        if not channel:
+            await self.reply(message, 'Failed to create channel `{}`'.format(channel_name))
+            return
+
+        await self.start_match(server, channel, roleteamA, roleteamB, self.formats[mode])
+
+    # Check a match can be created, returns its room name and the team roles
+    # in a random order, or None after replying why not
+    async def prepare_match(self, message, server, _roleteamA, _roleteamB, mode):
+        format = self.formats.get(mode)
+        maps = self.config['servers'][server.name]['maps']
+
+        if not format:
+            await self.reply(message, 'Unknown match format "{}", use one of: {}'\
+                             .format(mode, ', '.join(sorted(self.formats.keys()))))
+            return None
+
+        error = format.check_pool(maps)
+        if error:
+            await self.reply(message, 'Format "{}" cannot be used here: {}'\
+                             .format(mode, error))
+            return None
+
         randomized = [ _roleteamA, _roleteamB ]
         random.shuffle(randomized)
         roleteamA, roleteamB = randomized[0], randomized[1]
@@ -443,19 +1118,31 @@ class RoleKeeper:
 
         if notfound:
             await self.reply(message, 'Role "{}" is not a known team'.format(notfound))
-            return
+            return None
 
         roleteamA_name_safe = sanitize_input(translit_input(teamA.name))
         roleteamB_name_safe = sanitize_input(translit_input(teamB.name))
         channel_name = 'match_{}_vs_{}'.format(roleteamA_name_safe, roleteamB_name_safe)  # TODO cup
-        topic = 'Match {} vs {}'.format(teamA.name, teamB.name)
+
+        return channel_name, roleteamA, roleteamB
+
+    # Create the room of a match with its permissions and topic, or reuse
+    # the existing one. Returns the channel, or None on failure
+    async def provision_room(self, server, channel_name, roleteamA, roleteamB, actor=None):
+        teamA = self.db[server]['teams'].get(roleteamA.name)
+        teamB = self.db[server]['teams'].get(roleteamB.name)
+        topic = 'Match {} vs {}'.format(teamA.name if teamA else roleteamA.name,
+                                        teamB.name if teamB else roleteamB.name)
 
         ref_role = self.get_special_role(server, 'referee')
 
         read_perms = discord.PermissionOverwrite(read_messages=True, send_messages=True)
         no_perms = discord.PermissionOverwrite(read_messages=False)
 
-        channel = discord.utils.get(server.channels, name=channel_name)
+        channel = self.get_channel(server, name=channel_name)
+        actor = actor or audit_actor('!schedule')
+        created = { 'name': channel_name,
+                    'teams': [ roleteamA.name, roleteamB.name ] }
 
         if not channel:
             try:
@@ -468,93 +1155,439 @@ class RoleKeeper:
                     (server.me, read_perms),
                     (ref_role, read_perms))
 
-                print('Created channel "<{channel}>"'\
-                      .format(channel=channel.name))
-            except:
-                print('WARNING: Failed to create channel "<{channel}>"'\
-                      .format(channel=channel.name))
+                self.on_channel_create(channel)
+                self.db[server]['rooms'].add(channel_name)
+                self.audit(server, actor, 'create_channel', audit_target('channel', channel),
+                           after=created)
+
+                log.info('Created channel "<{channel}>"'\
+                         .format(channel=channel.name),
+                         server=server, match=channel_name, action='create_channel')
+            except Exception as e:
+                self.audit(server, actor, 'create_channel',
+                           { 'type': 'channel', 'id': None, 'name': channel_name },
+                           after=created, error=e)
+                log.warning('Failed to create channel "<{channel}>"'\
+                            .format(channel=channel_name),
+                            server=server, match=channel_name, action='create_channel')
+                return None
 
             try:
                 await self.client.edit_channel(
                     channel,
                     topic=topic)
-
-                print('Set topic for channel "<{channel}>" to "{topic}"'\
-                      .format(channel=channel.name, topic=topic))
-            except:
-                print('WARNING: Failed to set topic for channel "<{channel}>"'\
-                      .format(channel=channel.name))
+                self.audit(server, actor, 'set_topic', audit_target('channel', channel),
+                           after={ 'topic': topic })
+
+                log.info('Set topic for channel "<{channel}>" to "{topic}"'\
+                         .format(channel=channel.name, topic=topic),
+                         server=server, match=channel_name, action='set_topic')
+            except Exception as e:
+                self.audit(server, actor, 'set_topic', audit_target('channel', channel),
+                           after={ 'topic': topic }, error=e)
+                log.warning('Failed to set topic for channel "<{channel}>"'\
+                            .format(channel=channel.name),
+                            server=server, match=channel_name, action='set_topic')
         else:
-            print('Reusing existing channel "<{channel}>"'\
-                  .format(channel=channel.name))
+            log.info('Reusing existing channel "<{channel}>"'\
+                     .format(channel=channel.name),
+                     server=server, match=channel_name, action='create_channel')
+
+        return channel
 
+    # Send the welcome message in a provisioned match room and begin the
+    # pick & ban sequence
+    async def start_match(self, server, channel, roleteamA, roleteamB, format):
+        channel_name = channel.name
         maps = self.config['servers'][server.name]['maps']
+        teamA = self.db[server]['teams'].get(roleteamA.name)
+        teamB = self.db[server]['teams'].get(roleteamB.name)
 
-        if mode == self.MATCH_BO3:
-            match = MatchBo3(roleteamA, roleteamB, maps)
-            template = welcome_message_bo3
-        elif mode == self.MATCH_BO2:
-            match = MatchBo2(roleteamA, roleteamB, maps)
-            template = welcome_message_bo2
-        else:
-            match = Match(roleteamA, roleteamB, maps)
-            template = welcome_message_bo1
+        match = Match(roleteamA, roleteamB, maps, format)
 
         self.db[server]['matches'][channel_name] = match
+        self.db[server]['rooms'].add(channel_name)
+        self.permissions.invalidate_server(server.id)
         handle = Handle(self, None, channel)
-        msg = template.format(m_teamA=roleteamA.mention,
-                              m_teamB=roleteamB.mention,
-                              teamA=teamA.name,
-                              teamB=teamB.name,
-                              maps='\n'.join([ ' - {}'.format(m) for m in maps ]))
+        msg = format.welcome.format(m_teamA=roleteamA.mention,
+                                    m_teamB=roleteamB.mention,
+                                    teamA=teamA.name if teamA else roleteamA.name,
+                                    teamB=teamB.name if teamB else roleteamB.name,
+                                    maps='\n'.join([ ' - {}'.format(m) for m in maps ]))
 
-        await self.client.send_message(channel, msg)
+        await handle.send(msg)
         await match.begin(handle)
+        self.arm_deadline(server, channel_name, match)
+        self.touch(server)
+
+    # Register a match starting at timestamp `start`. Its room is created
+    # in the background well before, so that only the welcome message and
+    # the sequence are left at start time. Scheduled matches are kept in
+    # `db[server]['schedule']` and survive restarts
+    async def schedule_match(self, message, server, _roleteamA, _roleteamB, mode, start):
+        if not self.check_server(server):
+            return
 
-    # Returns if a member is a team captain in the given channel
-    def is_captain_in_match(self, member, channel):
-        server = member.server
+        prepared = await self.prepare_match(message, server, _roleteamA, _roleteamB, mode)
+        if not prepared:
+            return
 
-        if server not in self.db:
-            return False
+        channel_name, roleteamA, roleteamB = prepared
 
-        if channel.name not in self.db[server]['matches']:
-            return False
+        if channel_name in self.db[server]['schedule'] \
+           or channel_name in self.db[server]['matches']:
+            await self.reply(message, 'Match `{}` already exists'.format(channel_name))
+            return
 
-        return self.db[server]['matches'][channel.name].is_in_match(member)
+        entry = { 'start': start,
+                  'format': mode,
+                  'teams': [ roleteamA.id, roleteamB.id ],
+                  'channel': message.channel.id,
+                  'provisioned': False }
+
+        self.db[server]['schedule'][channel_name] = entry
+        self.arm_schedule(server, channel_name, entry)
+        self.checkpoint(server, 'schedule', force=True)
+
+        await self.reply(message, 'Match `{}` scheduled at {}'\
+                         .format(channel_name,
+                                 time.strftime('%d/%m %H:%M', time.localtime(start))))
+
+    # Arm the provisioning and start timers of a scheduled match, both run
+    # in the match mailbox so a start never races its provisioning.
+    # Provisioning jobs are spread PROVISION_INTERVAL seconds apart so that
+    # a whole round never hits the rate limits at once
+    PROVISION_INTERVAL = 5.0
+
+    def arm_schedule(self, server, channel_name, entry):
+        if not entry['provisioned']:
+            now = time.time()
+            interval = self.config.get('provision_interval', self.PROVISION_INTERVAL)
+            slot = max(now, self.next_provision.get(server.id, 0))
+            self.next_provision[server.id] = slot + interval
+
+            self.timers.schedule(('provision', server.id, channel_name),
+                                 slot,
+                                 self.submit_match,
+                                 server.id, channel_name,
+                                 self.provision_scheduled,
+                                 server.id, channel_name)
+
+        self.timers.schedule(('start', server.id, channel_name),
+                             entry['start'],
+                             self.submit_match,
+                             server.id, channel_name,
+                             self.start_scheduled,
+                             server.id, channel_name)
+
+    def cancel_schedule(self, server, channel_name):
+        self.timers.cancel(('provision', server.id, channel_name))
+        self.timers.cancel(('start', server.id, channel_name))
+        return self.db[server]['schedule'].pop(channel_name, None)
+
+    # Returns the team roles of a scheduled match, None if one is gone
+    def scheduled_roles(self, server, entry):
+        roles = [ self.resolve_role(server, role_id) for role_id in entry['teams'] ]
+        return roles if all(roles) else None
+
+    async def provision_scheduled(self, server_id, channel_name):
+        server = self.client.get_server(server_id)
+
+        if not server or server not in self.db:
+            return
 
-    # Ban a map
-    async def ban_map(self, member, channel, map_unsafe, force=False):
-        server = member.server
-        banned_map_safe = sanitize_input(translit_input(map_unsafe))
+        entry = self.db[server]['schedule'].get(channel_name)
+
+        if not entry or entry['provisioned']:
+            return
+
+        roles = self.scheduled_roles(server, entry)
+
+        if not roles:
+            log.warning('Missing team role, cannot provision "{}"'.format(channel_name),
+                        server=server, match=channel_name, action='provision')
+            return
+
+        started = time.time()
+        channel = await self.provision_room(server, channel_name, roles[0], roles[1])
+
+        # The match may have been unscheduled in the meantime
+        entry = self.db[server]['schedule'].get(channel_name)
+
+        if channel and entry:
+            entry['provisioned'] = True
+            self.checkpoint(server, 'schedule', 'rooms')
+
+            log.info('Provisioned scheduled match "{}"'.format(channel_name),
+                     server=server, match=channel_name, action='provision',
+                     duration=time.time() - started)
+
+    async def start_scheduled(self, server_id, channel_name):
+        server = self.client.get_server(server_id)
+
+        if not server or server not in self.db:
+            return
+
+        entry = self.db[server]['schedule'].get(channel_name)
+
+        if not entry:
+            return
+
+        # Provisioning failed or did not run yet, do it now
+        if not entry['provisioned']:
+            self.timers.cancel(('provision', server.id, channel_name))
+            await self.provision_scheduled(server.id, channel_name)
+
+        entry = self.cancel_schedule(server, channel_name)
+        self.checkpoint(server, 'schedule', force=True)
+
+        if not entry:
+            return
+
+        referees = self.get_channel(server, id=entry['channel'])
+
+        # A referee started the match by hand in the meantime, keep it
+        if channel_name in self.db[server]['matches']:
+            log.warning('Scheduled match "{}" already started'.format(channel_name),
+                        server=server, match=channel_name, action='start')
+            if referees:
+                self.outbox.send(referees, ':warning: Scheduled match `{}` was already started by hand'\
+                                 .format(channel_name))
+            return
+
+        channel = self.get_channel(server, name=channel_name)
+        format = self.formats.get(entry['format'])
+        roles = self.scheduled_roles(server, entry)
+
+        if not channel or not format or not roles:
+            log.error('Cannot start scheduled match "{}"'.format(channel_name),
+                      server=server, match=channel_name, action='start')
+
+            if referees:
+                self.outbox.send(referees, ':warning: Scheduled match `{}` could not be started'\
+                                 .format(channel_name))
+            return
+
+        await self.start_match(server, channel, roles[0], roles[1], format)
+
+    # List the scheduled matches
+    async def list_schedule(self, message):
+        server = message.server
 
         if not self.check_server(server):
             return
 
-        if channel.name not in self.db[server]['matches']:
+        schedule = sorted(self.db[server]['schedule'].items(), key=lambda e: e[1]['start'])
+
+        if not schedule:
+            await self.reply(message, 'No scheduled match')
             return
 
-        handle = Handle(self, member, channel)
-        await self.db[server]['matches'][channel.name].ban_map(handle, banned_map_safe, force)
+        await self.reply(message, '\n' + '\n'.join([ '`{match_id}` ({format}) at {date}{ready}'\
+                                                     .format(match_id=name,
+                                                             format=entry['format'],
+                                                             date=time.strftime('%d/%m %H:%M', time.localtime(entry['start'])),
+                                                             ready=', room ready' if entry['provisioned'] else '') \
+                                                     for name, entry in schedule ]))
 
-    # Pick a map
-    async def pick_map(self, member, channel, map_unsafe, force=False):
-        server = member.server
-        picked_map_safe = sanitize_input(translit_input(map_unsafe))
+    # Cancel a scheduled match, its room is kept if already created
+    async def unschedule_match(self, message, match_id):
+        server = message.server
 
         if not self.check_server(server):
             return
 
-        if channel.name not in self.db[server]['matches']:
+        if not self.cancel_schedule(server, match_id):
+            await self.reply(message, 'No scheduled match `{}`'.format(match_id))
             return
 
-        handle = Handle(self, member, channel)
-        await self.db[server]['matches'][channel.name].pick_map(handle, picked_map_safe, force)
+        self.checkpoint(server, 'schedule', force=True)
+        self.discard_mailbox(server, match_id)
+        await self.reply(message, 'Match `{}` unscheduled'.format(match_id))
+
+    # Returns the configured time limit in seconds for a sequence action
+    def get_deadline_config(self, server, key, default=None):
+        try:
+            return self.config['servers'][server.name]['deadlines'][key]
+        except KeyError:
+            return default
+
+    # Returns the digest window in seconds of a broadcast, None if its
+    # events are delivered immediately
+    def get_digest_window(self, server, bcast_id):
+        try:
+            return self.config['servers'][server.name]['digests'][bcast_id]
+        except KeyError:
+            return None
+
+    # Arm the timer of the current turn of a match
+    # 1. Cancel it if the sequence is over or the action has no time limit
+    # 2. Start a new deadline whenever the turn changed
+    # 3. Schedule the reminder first if not sent yet, then the deadline
+    def arm_deadline(self, server, channel_name, match):
+        key = ('deadline', server.id, channel_name)
+
+        # Matches created before deadlines were introduced
+        if not hasattr(match, 'deadline'):
+            match.deadline = None
+            match.deadline_turn = None
+            match.reminded = False
+
+        if match.is_over():
+            match.deadline = None
+            self.timers.cancel(key)
+            return
+
+        if match.deadline is None or match.deadline_turn != match.turn:
+            _, action = match.step()
+            delay = self.get_deadline_config(server, action)
+
+            if not delay:
+                match.deadline = None
+                self.timers.cancel(key)
+                return
+
+            match.deadline = time.time() + delay
+            match.deadline_turn = match.turn
+            match.reminded = False
+
+        reminder = self.get_deadline_config(server, 'reminder')
+        when = match.deadline
+
+        if reminder and not match.reminded and match.deadline - reminder > time.time():
+            when = match.deadline - reminder
+
+        self.timers.schedule(key, when, self.on_deadline, server.id, channel_name, match.turn)
+
+    # Run `func(*args)` in the mailbox of a match room, then drop the mailbox
+    # if the room has no running or scheduled match left
+    async def submit_match(self, server_id, channel_name, func, *args):
+        try:
+            return await self.mailboxes.submit((server_id, channel_name), func, *args)
+        finally:
+            server = self.client.get_server(server_id)
+
+            if server in self.db:
+                self.discard_mailbox(server, channel_name)
+            else:
+                self.mailboxes.discard((server_id, channel_name))
+
+    def discard_mailbox(self, server, channel_name):
+        if channel_name not in self.db[server]['matches'] \
+           and channel_name not in self.db[server]['schedule']:
+            self.mailboxes.discard((server.id, channel_name))
+
+    # Fired by the timers when a turn reminder or deadline is reached
+    # 1. Remind the team whose turn it is
+    # 2. On timeout, play a random choice for the team (`deadlines/timeout`
+    #    set to "random")
+    # 3. Otherwise, escalate to the referees
+    async def on_deadline(self, server_id, channel_name, turn):
+        await self.submit_match(server_id, channel_name,
+                                self.resolve_deadline,
+                                server_id, channel_name, turn)
+
+    # Only ever called from the match mailbox
+    async def resolve_deadline(self, server_id, channel_name, turn):
+        server = self.client.get_server(server_id)
+
+        if not server or server not in self.db:
+            return
+
+        match = self.db[server]['matches'].get(channel_name)
+
+        # The turn was played in the meantime
+        if not match or match.turn != turn or match.deadline is None:
+            return
+
+        channel = self.get_channel(server, name=channel_name)
+
+        if not channel:
+            return
+
+        handle = Handle(self, None, channel)
+        team, action = match.step(turn)
+
+        # 1. Remind the team whose turn it is
+        if time.time() < match.deadline:
+            match.reminded = True
+            await handle.send(':alarm_clock: {team}, {seconds} seconds left to use `!{action} xxxxx`!'\
+                              .format(team=team.mention,
+                                      seconds=int(match.deadline - time.time()),
+                                      action=action))
+            self.arm_deadline(server, channel_name, match)
+            return
+
+        match.deadline = None
+        policy = self.get_deadline_config(server, 'timeout', 'referee')
+
+        log.info('{ch}: {team} ran out of time to {action} ({policy})'\
+                 .format(ch=channel_name,
+                         team=team,
+                         action=action,
+                         policy=policy),
+                 server=server, match=channel_name, action='deadline')
+
+        # 2. Play a random choice for the team, if any is left
+        if policy == 'random':
+            choice = match.random_choice(action)
+            if choice is None:
+                log.warning('{ch}: no choice left to {action} at random'\
+                            .format(ch=channel_name, action=action),
+                            server=server, match=channel_name, action='deadline')
+                return
+
+            await handle.send(':alarm_clock: Time is up {team}! Randomly chosen {action}: **{choice}**'\
+                              .format(team=team.mention,
+                                      action=action,
+                                      choice=choice))
+
+            await self.apply_turn(action, None, channel,
+                                  sanitize_input(translit_input(choice)),
+                                  force=True)
+
+        # 3. Escalate to the referees
+        else:
+            ref_role = self.get_special_role(server, 'referee')
+            await handle.send(':alarm_clock: Time is up {team}! {referees}, please take over with `!{action} xxxxx`.'\
+                              .format(team=team.mention,
+                                      referees=ref_role.mention if ref_role else 'Referees',
+                                      action=action))
+            await handle.broadcast('deadline', ':alarm_clock: `{match_id}`: **{team}** ran out of time to {action}'\
+                                   .format(match_id=channel_name,
+                                           team=team,
+                                           action=action))
+
+    # Whether `channel` is the room of a match already archived
+    def is_finished_room(self, server, channel):
+        if server not in self.db:
+            return False
+
+        return channel.name in self.db[server]['rooms'] \
+            and channel.name not in self.db[server]['matches'] \
+            and channel.name not in self.db[server]['schedule']
+
+    # Returns if a member is a team captain in the given channel
+    def is_captain_in_match(self, member, channel):
+        return self.permissions.get(member).is_captain_in(channel.name)
+
+    # Ban a map
+    async def ban_map(self, member, channel, map_unsafe, force=False):
+        await self.play_turn('ban', member, channel, map_unsafe, force)
+
+    # Pick a map
+    async def pick_map(self, member, channel, map_unsafe, force=False):
+        await self.play_turn('pick', member, channel, map_unsafe, force)
 
     # Choose sides
     async def choose_side(self, member, channel, side_unsafe, force=False):
+        await self.play_turn('side', member, channel, side_unsafe, force)
+
+    # Queue a sequence command in the mailbox of the match room, so that
+    # commands of one match are applied strictly one after the other while
+    # other match rooms are processed in parallel
+    async def play_turn(self, action, member, channel, value_unsafe, force=False):
         server = member.server
-        side_safe = sanitize_input(translit_input(side_unsafe))
 
         if not self.check_server(server):
             return
@@ -562,11 +1595,89 @@ class RoleKeeper:
         if channel.name not in self.db[server]['matches']:
             return
 
+        value_safe = sanitize_input(translit_input(value_unsafe))
+        await self.submit_match(server.id, channel.name,
+                                self.apply_turn,
+                                action, member, channel, value_safe, force)
+
+    # Apply a sequence command, only ever called from the match mailbox
+    async def apply_turn(self, action, member, channel, value_safe, force=False):
+        server = member.server if member else channel.server
+
+        # The match may have ended while the command was waiting
+        match = self.db[server]['matches'].get(channel.name)
+        if not match:
+            if member:
+                await Handle(self, member, channel).reply('This match is over, see `!history` for its summary')
+            return
+
         handle = Handle(self, member, channel)
-        await self.db[server]['matches'][channel.name].choose_side(handle, side_safe, force)
+
+        if action == 'ban':
+            await match.ban_map(handle, value_safe, force)
+        elif action == 'pick':
+            await match.pick_map(handle, value_safe, force)
+        elif action == 'side':
+            await match.choose_side(handle, value_safe, force)
+
+        self.arm_deadline(server, channel.name, match)
+        self.touch(server)
+
+        if match.is_over():
+            await self.archive_match(server, channel.name, match)
+
+    # Move a finished match out of the live matches into the match archive,
+    # only its summary record is kept
+    async def archive_match(self, server, channel_name, match):
+        record = match.record(channel_name)
+
+        try:
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(None, self.archives[server.id].append, record)
+        except Exception as e:
+            log.error('Failed to archive match "{}": {}'.format(channel_name, e),
+                      server=server, match=channel_name, action='archive')
+            return
+
+        self.timers.cancel(('deadline', server.id, channel_name))
+        del self.db[server]['matches'][channel_name]
+        self.permissions.invalidate_server(server.id)
+        self.touch(server)
+
+        log.info('Archived match "{}"'.format(channel_name),
+                 server=server, match=channel_name, action='archive')
+
+    # List the most recent finished matches, optionally of given teams
+    async def match_history(self, message, query):
+        server = message.server
+
+        if not self.check_server(server):
+            return
+
+        loop = asyncio.get_event_loop()
+        records = await loop.run_in_executor(None, self.archives[server.id].query, query)
+
+        if not records:
+            await self.reply(message, 'No finished match found')
+            return
+
+        lines = []
+        for record in records:
+            lines.append('`{match_id}` ({format}, {date}): **{teamA}** vs **{teamB}** - {maps}'\
+                         .format(match_id=record['match_id'],
+                                 format=record['format'],
+                                 date=time.strftime('%d/%m %H:%M', time.localtime(record['finished'])),
+                                 teamA=record['teams'][0],
+                                 teamB=record['teams'][1],
+                                 maps=', '.join([ '{} ({} {})'.format(m['map'], m['team'], record['side']) \
+                                                  for m in record['maps'] ])))
+
+        await self.reply(message, '\n' + '\n'.join(lines))
 
     # Broadcast information that the match is or will be streamed
-    # 1. Notify captains match will be streamed
+    # 1. Find the match room, either from its exact name or from partial
+    #    team names
+    # 2. Notify captains match will be streamed
     async def stream_match(self, message, match_id):
         server = message.server
 
@@ -574,114 +1685,376 @@ class RoleKeeper:
             return
 
         member = message.author
-        channel = discord.utils.get(member.server.channels, name=match_id)
+        channel = self.get_channel(server, name=match_id)
+
+        # 1. Find the match room from partial team names
+        if not channel and match_id:
+            found = self.channels[server.id].find_matches(match_id)
+
+            if len(found) > 1:
+                await self.reply(message, 'Which match? {}'\
+                                 .format(', '.join('`{}`'.format(c.name) for c in found[:10])))
+                return
+            elif found:
+                channel = found[0]
+
+        # 2. Find the match room of a team from its name
+        if not channel and match_id:
+            role_ids = set(self.db[server]['teams'][n].role_id \
+                           for n in self.find_teams(server, match_id))
+            found = sorted(name for name, match in self.db[server]['matches'].items() \
+                           if match.teamA.id in role_ids or match.teamB.id in role_ids)
+
+            if len(found) > 1:
+                await self.reply(message, 'Which match? {}'\
+                                 .format(', '.join('`{}`'.format(name) for name in found[:10])))
+                return
+            elif found:
+                channel = self.get_channel(server, name=found[0])
 
         # If we found a channel with the given name
         if channel:
 
-            # 1. Notify captains match will be streamed
+            # 3. Notify captains match will be streamed
             await self.client.send_message(
                 channel, ':eye::popcorn: _**{}** will stream this match!_ :movie_camera::satellite:\n'
                 ':arrow_forward: _8.6 Teams participating in a streamed match get an additional 10 minutes to prepare; the time of the match may change per the decision of the Staff/Organizers._\n'\
                 .format(member.nick if member.nick else member.name))
             await self.reply(message, 'roger!')
 
-            print('Notified "{channel}" the match will be streamed by "{member}"'\
-                  .format(channel=channel.name,
-                          member=str(member)))
+            log.info('Notified "{channel}" the match will be streamed by "{member}"'\
+                     .format(channel=channel.name,
+                             member=str(member)))
         else:
             await self.reply(message, 'This match does not exist!')
 
 
     # Remove all teams
     # 1. Delete all existing team roles
-    # 2. Find all members with role team captain
-    # 3. Remove group role from member
-    # 4. Remove team captain and group roles from member
-    # 5. Reset member nickname
-    async def wipe_teams(self, server):
+    # 2. Remove team captain and group roles from all captains
+    # 3. Reset captains nickname
+    async def wipe_teams(self, server, channel=None, actor=None):
         if not self.check_server(server):
             return
 
+        items = [ ('role', role_name) for role_name in self.db[server]['teams'].keys() ] \
+              + [ ('captain', discord_id) for discord_id in self.db[server]['captains'].keys() ] # TODO cup
+
+        await self.start_teardown(server, 'teams', items, channel, actor)
+
+    # Remove all match rooms
+    # 1. Find all match channels that where created by the bot for this cup
+    # 2. Delete channel
+    async def wipe_matches(self, server, channel=None, actor=None):
+        if not self.check_server(server):
+            return
+
+        items = [ ('channel', channel_name) for channel_name in self.db[server]['rooms'] ] # TODO cup
+
+        await self.start_teardown(server, 'matches', items, channel, actor)
+
+    # Start a bulk teardown, unless one is already running. A teardown of the
+    # same kind left with failed items is retried instead
+    async def start_teardown(self, server, kind, items, channel=None, actor=None):
+        record = self.db[server].get('teardown')
+
+        if record:
+            if server.id in self.teardowns or record['kind'] != kind:
+                if channel:
+                    await self.client.send_message(channel,
+                                                   'A teardown of {} is {}'\
+                                                   .format(record['kind'],
+                                                           'already running' if server.id in self.teardowns \
+                                                           else 'unfinished, retry it first'))
+                return
+
+            record['channel'] = channel.id if channel else record['channel']
+            await self.run_teardown(server)
+            return
+
+        self.db[server]['teardown'] = { 'kind': kind,
+                                        'pending': set(items),
+                                        'total': len(items),
+                                        'failed': 0,
+                                        'channel': channel.id if channel else None,
+                                        'actor': actor or audit_actor('!wipe_' + kind) }
+        self.checkpoint(server, 'teardown', force=True)
+
+        await self.run_teardown(server)
+
+    # Run, or resume after a restart, the bulk teardown of a server
+    # 1. Process pending items concurrently, up to `teardown_concurrency` at
+    #    a time, as bulk calls of the FairScheduler. discord.py handles the
+    #    rate limits of each request
+    # 2. Checkpoint the remaining items so that a restart resumes the work,
+    #    failed items stay pending
+    # 3. Report progress in the channel the teardown was started from
+    # 4. Once everything is processed, clear the wiped tables. If some items
+    #    failed, keep the tables and the record, running the same wipe
+    #    again retries them
+    async def run_teardown(self, server):
+        record = self.db[server]['teardown']
+        record['failed'] = 0
+        record['stopped'] = False
+        self.teardowns.add(server.id)
+
+        try:
+            await self.run_teardown_items(server, record)
+        finally:
+            self.teardowns.discard(server.id)
+
+    async def run_teardown_items(self, server, record):
+        kind = record['kind']
+
+        channel = None
+        if record['channel']:
+            channel = self.get_channel(server, id=record['channel'])
+
+        progress = Progress(self.client, channel,
+                            'Wiping {}'.format(kind),
+                            record['total'])
+        await progress.start(record['total'] - len(record['pending']), record['failed'])
+
         captain_role = self.get_special_role(server, 'captain') # TODO cup, not special?
+        limit = asyncio.Semaphore(self.config.get('teardown_concurrency', 5))
+        actor = record.get('actor') or audit_actor('!wipe_' + kind)
 
-        # 1. Delete all existing team roles
-        for role_name, team in self.db[server]['teams'].items():
-            try:
-                await self.client.delete_role(server, team.role)
-                print ('Deleted role "{role}"'\
-                       .format(role=role_name))
-            except:
-                print ('WARNING: Failed to delete role "{role}"'\
-                       .format(role=role_name))
-                pass
+        async def run(item):
+            async with limit, self.scheduler.slot(server.id, bulk=True):
+                ok = await self.teardown_item(server, item, captain_role, actor)
 
-        self.db[server]['teams'].clear()
+            # 2. Checkpoint the remaining items
+            if ok:
+                record['pending'].discard(item)
+            else:
+                record['failed'] += 1
+            self.checkpoint(server, 'teardown')
 
-        # 2. Find all members with role team captain
-        for member in server.members: # TODO go through db instead
-            discord_id = str(member)
-            if discord_id not in self.db[server]['captains']: # TODO cup
-                continue
+            # 3. Report progress
+            await progress.update(record['total'] - len(record['pending']), record['failed'])
 
-            captain = self.db[server]['captains'][discord_id] # TODO cup
+        # 1. Process pending items concurrently
+        await asyncio.gather(*[ run(item) for item in list(record['pending']) ])
 
-            print ('Found captain "{member}"'\
-                   .format(member=discord_id))
+        if record['pending']:
+            record['stopped'] = True
+            self.checkpoint(server, 'teardown', force=True)
 
-            # 3. Remove group role from member
-            group_role = self.db[server]['groups'][captain.group] \
-                         if captain.group in self.db[server]['groups'] \
-                         else None
+            await progress.finish(record['total'] - len(record['pending']), record['failed'])
+            log.warning('Wipe of {kind} incomplete: {failed} item(s) failed, kept for a retry'\
+                        .format(kind=kind, failed=record['failed']),
+                        server=server, action='wipe_' + kind)
+            if channel:
+                self.outbox.send(channel, '{failed} item(s) could not be wiped, use `!wipe_{kind}` again to retry'\
+                                 .format(failed=record['failed'], kind=kind))
+            return
 
-            crole_name = captain_role.name
-            grole_name = group_role.name if group_role else '<no group>'
+        # 4. Clear the wiped tables
+        if kind == 'teams':
+            self.db[server]['teams'].clear()
+            self.db[server]['captains'].clear() # TODO cup
+        elif kind == 'matches':
+            for channel_name in self.db[server]['matches'].keys():
+                self.timers.cancel(('deadline', server.id, channel_name))
+                self.mailboxes.discard((server.id, channel_name))
+
+            for channel_name in list(self.db[server]['schedule'].keys()):
+                self.cancel_schedule(server, channel_name)
+
+            self.db[server]['matches'].clear() # TODO cup
+            self.permissions.invalidate_server(server.id)
+            self.db[server]['rooms'].clear()
+
+        del self.db[server]['teardown']
+        self.touch(server)
+        self.checkpoint(server, force=True)
+
+        await progress.finish(record['total'], record['failed'])
+        log.info('Wiped {kind}: {total} item(s), {failed} failure(s)'\
+                 .format(kind=kind, total=record['total'], failed=record['failed']),
+                 server=server, action='wipe_' + kind)
+
+    # Undo one thing the bot created, returns False on failure
+    async def teardown_item(self, server, item, captain_role, actor=None):
+        kind, key = item
+
+        # Delete a team role
+        if kind == 'role':
+            team = self.db[server]['teams'].get(key)
+            role = self.resolve_role(server, team.role_id) if team else None
+            if not role:
+                return True
 
-            # 4. Remove team captain and group roles from member
             try:
-                await self.client.remove_roles(member, captain_role, group_role)
-                print ('Remove roles "{crole}" and "{grole}" from "{member}"'\
-                       .format(member=discord_id,
-                               crole=crole_name,
-                               grole=grole_name))
-            except:
-                print ('WARNING: Failed to remove roles "{crole}" and "{grole}" from "{member}"'\
-                       .format(member=discord_id,
-                               crole=crole_name,
-                               grole=grole_name))
+                await self.client.delete_role(server, role)
+                self.audit(server, actor, 'delete_role', audit_target('role', role))
+                log.info('Deleted role "{role}"'\
+                         .format(role=key))
+            except discord.errors.NotFound:
                 pass
+            except Exception as e:
+                self.audit(server, actor, 'delete_role', audit_target('role', role), error=e)
+                log.warning('Failed to delete role "{role}"'\
+                            .format(role=key))
+                return False
+
+        # Remove captain and group roles and reset nickname of a captain
+        elif kind == 'captain':
+            captain = self.db[server]['captains'].get(key)
+            member = server.get_member_named(key)
+
+            if not captain or not member:
+                return True
+
+            group_role = self.get_group_role(server, captain.group)
+
+            crole_name = captain_role.name if captain_role else '<no captain role>'
+            grole_name = group_role.name if group_role else '<no group>'
+            roles = [ r for r in (captain_role, group_role) if r ]
+
+            before = member_state(member)
+            after = dict(before, roles=[ r for r in before['roles'] \
+                                         if r not in (crole_name, grole_name) ])
 
-            # 5. Reset member nickname
+            try:
+                await self.client.remove_roles(member, *roles)
+                self.audit(server, actor, 'remove_roles', audit_target('member', member), before, after)
+                log.info('Remove roles "{crole}" and "{grole}" from "{member}"'\
+                         .format(member=key,
+                                 crole=crole_name,
+                                 grole=grole_name))
+            except Exception as e:
+                self.audit(server, actor, 'remove_roles', audit_target('member', member), before, after, e)
+                log.warning('Failed to remove roles "{crole}" and "{grole}" from "{member}"'\
+                            .format(member=key,
+                                    crole=crole_name,
+                                    grole=grole_name))
+                return False
+
+            nick = member.nick
             try:
                 await self.client.change_nickname(member, None)
-                print ('Reset nickname for "{member}"'\
-                       .format(member=discord_id))
-            except:
-                print ('WARNING: Failed to reset nickname for "{member}"'\
-                       .format(member=discord_id))
+                self.audit(server, actor, 'reset_nickname', audit_target('member', member),
+                           { 'nick': nick }, { 'nick': None })
+                log.info('Reset nickname for "{member}"'\
+                         .format(member=key))
+            except Exception as e:
+                self.audit(server, actor, 'reset_nickname', audit_target('member', member),
+                           { 'nick': nick }, { 'nick': None }, e)
+                log.warning('Failed to reset nickname for "{member}"'\
+                            .format(member=key))
+                return False
+
+        # Delete a match room
+        elif kind == 'channel':
+            channel = self.get_channel(server, name=key)
+            if not channel:
+                return True
+
+            try:
+                await self.client.delete_channel(channel)
+                self.on_channel_delete(channel)
+                self.audit(server, actor, 'delete_channel', audit_target('channel', channel))
+                log.info('Deleted channel "{channel}"'\
+                         .format(channel=key))
+            except discord.errors.NotFound:
                 pass
+            except Exception as e:
+                self.audit(server, actor, 'delete_channel', audit_target('channel', channel), error=e)
+                log.warning('Fail to Delete channel "{channel}"'\
+                            .format(channel=key))
+                return False
 
-        self.db[server]['captains'].clear() # TODO cup
+        return True
+
+    # Write the records `keys` of the server DB to disk, all the cached ones
+    # if none is given, at most once per CHECKPOINT_INTERVAL unless forced.
+    # Unlike Shelf.sync, the writeback cache is kept: the objects held by
+    # running code (teardown and refresh records, matches) stay the stored
+    # ones, and only the given records are pickled again
+    CHECKPOINT_INTERVAL = 1.0
+
+    def checkpoint(self, server, *keys, force=False):
+        now = time.time()
+        last = (server.id,) + keys
+
+        if not force and now - self.last_checkpoint.get(last, 0) < self.CHECKPOINT_INTERVAL:
+            return
+
+        self.last_checkpoint[last] = now
+        db = self.db[server]
+
+        for key in keys or list(db.cache.keys()):
+            if key in db:
+                # Writes through to the dbm file, and keeps the cache entry
+                db[key] = db[key]
+
+        sync = getattr(db.dict, 'sync', None)
+        if sync:
+            sync()
+
+    # Record a Discord mutation in the audit log of the server, see AuditLog.
+    # Records are indexed by the target member and the member behind the
+    # command, if any
+    def audit(self, server, actor, action, target, before=None, after=None, error=None):
+        members = [ actor['id'] if actor else None ]
+        if target['type'] == 'member':
+            members.append(target['id'])
+
+        self.audits[server.id].append({ 'server': server.name,
+                                        'actor': actor,
+                                        'action': action,
+                                        'target': target,
+                                        'before': before,
+                                        'after': after,
+                                        'outcome': 'ok' if error is None \
+                                                   else 'error: {}'.format(error if isinstance(error, str) else repr(error)) },
+                                      members)
+
+    # Reply with the most recent audit records of a member, one line each.
+    # States longer than AUDIT_STATE_LENGTH characters are cut, and the
+    # lines go through the outbox, which splits them over several posts
+    AUDIT_STATE_LENGTH = 300
+
+    async def audit_member(self, message, member, limit=10):
+        server = message.server
 
-    # Remove all match rooms
-    # 1. Find all match channels that where created by the bot for this cup
-    # 2. Delete channel
-    async def wipe_matches(self, server):
         if not self.check_server(server):
             return
 
-        for channel_name in self.db[server]['matches'].keys(): # TODO cup
-            channel = discord.utils.get(server.channels, name=channel_name)
-            if channel:
-                try:
-                    await self.client.delete_channel(channel)
-                    print ('Deleted channel "{channel}"'\
-                           .format(channel=channel_name))
-                except:
-                    print ('WARNING: Fail to Delete channel "{channel}"'\
-                           .format(channel=channel_name))
+        loop = asyncio.get_event_loop()
+        records = await loop.run_in_executor(None, self.audits[server.id].query, member.id, limit)
 
-        self.db[server]['matches'].clear() # TODO cup
+        if not records:
+            await self.reply(message, 'No audit record for {}'.format(member.mention))
+            return
+
+        def state(value):
+            text = json.dumps(value, ensure_ascii=False)
+            if len(text) > self.AUDIT_STATE_LENGTH:
+                text = text[:self.AUDIT_STATE_LENGTH - 3] + '...'
+            return text
+
+        lines = []
+        for record in records:
+            changes = ''
+            if record['before'] is not None or record['after'] is not None:
+                changes = ': `{}` -> `{}`'.format(state(record['before']), state(record['after']))
+
+            lines.append('`{date}` {command} ({author}) {action} {type} "{name}"{changes} [{outcome}]'\
+                         .format(date=time.strftime('%d/%m %H:%M:%S', time.localtime(record['time'])),
+                                 command=record['actor']['command'],
+                                 author=record['actor']['member'] or 'bot',
+                                 action=record['action'],
+                                 type=record['target']['type'],
+                                 name=record['target']['name'],
+                                 changes=changes,
+                                 outcome=record['outcome'][:self.AUDIT_STATE_LENGTH]))
+
+        self.outbox.send(message.channel, '{} Last {} audit record(s) of {}:'\
+                         .format(message.author.mention, len(lines), member.mention))
+        for line in lines:
+            self.outbox.send(message.channel, line)
 
     # Remove all messages that are not pinned in a given channel
     async def wipe_messages(self, message, channel):
@@ -696,7 +2069,7 @@ class RoleKeeper:
                 msg async for msg in self.client.logs_from(channel) if not msg.pinned ]
             count = len(messages_to_delete)
         except:
-            print('WARNING: No permission to read logs from "{}"'.format(channel.name))
+            log.warning('No permission to read logs from "{}"'.format(channel.name))
             return
 
         reply = await self.reply(message,
@@ -705,17 +2078,18 @@ class RoleKeeper:
 
         for msg in messages_to_delete:
             try:
-                await self.client.delete_message(msg)
+                async with self.scheduler.slot(server.id, bulk=True):
+                    await self.client.delete_message(msg)
             except:
                 count = count - 1
-                print('WARNING: No permission to delete in "{}"'.format(channel.name))
+                log.warning('No permission to delete in "{}"'.format(channel.name))
                 pass
 
         await self.client.edit_message(reply, '{mention} Deleted {count} messages.'\
                                        .format(mention=message.author.mention,
                                                count=count))
-        print ('Deleted {count} messages in "{channel}"'\
-               .format(count=count, channel=channel.name))
+        log.info('Deleted {count} messages in "{channel}"'\
+                 .format(count=count, channel=channel.name))
 
     # Announcement message
     async def announce(self, msg, message):
@@ -754,13 +2128,187 @@ class RoleKeeper:
                                         csv,
                                         filename=filename,
                                         content=msg)
-            print ('Sent member list ({})'.format(member_count))
+            log.info('Sent member list ({})'.format(member_count))
         except Exception as e:
-            print ('ERROR: Failed to send member list ({})'.format(member_count))
+            log.error('Failed to send member list ({})'.format(member_count))
             raise e
 
         csv.close()
 
+    # Export the tournament state of the server to a snapshot file, see
+    # snapshot.py. The DB is read on the event loop, compression and writing
+    # happen in the background
+    async def export_snapshot(self, message):
+        server = message.server
+
+        if not self.check_server(server):
+            return
+
+        db_name = self.config['servers'][server.name]['db']
+        path = db_file(db_name, '.snapshot.jsonl.gz')
+        lines = list(snapshot_lines(self.db[server], server.name, db_name))
+
+        started = time.time()
+        loop = asyncio.get_event_loop()
+        counts = await loop.run_in_executor(None, write_snapshot, path, lines)
+
+        log.info('Exported snapshot "{}"'.format(path),
+                 server=server, action='snapshot_export', duration=time.time() - started)
+
+        await self.client.send_file(message.channel,
+                                    path,
+                                    filename='{}.snapshot.jsonl.gz'.format(db_name),
+                                    content='{mention} Snapshot of {counts}'\
+                                    .format(mention=message.author.mention,
+                                            counts=', '.join('{} {}'.format(counts[t], t) \
+                                                             for t in TABLES)))
+
+    # Replace the tournament state of the server with a snapshot: the file
+    # attached to the message, or the last one exported otherwise
+    # 1. Download and read the whole snapshot before touching anything
+    # 2. Stop the timers and mailboxes of the current matches
+    # 3. Swap the tables, then re-arm deadlines and scheduled matches
+    async def import_snapshot(self, message):
+        server = message.server
+
+        if not self.check_server(server):
+            return
+
+        if self.db[server].get('teardown'):
+            await self.reply(message, 'A teardown of {} is running, try again later'\
+                             .format(self.db[server]['teardown']['kind']))
+            return
+
+        db_name = self.config['servers'][server.name]['db']
+        path = db_file(db_name, '.snapshot.jsonl.gz')
+
+        started = time.time()
+        loop = asyncio.get_event_loop()
+
+        # 1. Download and read the snapshot
+        try:
+            if message.attachments:
+                path = db_file(db_name, '.import.jsonl.gz')
+                async with aiohttp.ClientSession() as session:
+                    async with session.get(message.attachments[0]['url']) as resp:
+                        if resp.status != 200:
+                            raise ValueError('download failed with HTTP {}'.format(resp.status))
+                        with open(path, 'wb') as f:
+                            while True:
+                                chunk = await resp.content.read(64 * 1024)
+                                if not chunk:
+                                    break
+                                f.write(chunk)
+
+            header, tables = await loop.run_in_executor(None, read_snapshot, path)
+        except (OSError, ValueError, aiohttp.ClientError) as e:
+            await self.reply(message, 'Cannot import snapshot: {}'.format(e))
+            return
+
+        # 2. Stop the current matches
+        for channel_name in self.db[server]['matches'].keys():
+            self.timers.cancel(('deadline', server.id, channel_name))
+            self.mailboxes.discard((server.id, channel_name))
+
+        for channel_name in list(self.db[server]['schedule'].keys()):
+            self.cancel_schedule(server, channel_name)
+
+        # 3. Swap the tables
+        restore_tables(self.db[server], tables)
+        self.resume_server(server)
+        self.checkpoint(server, *(TABLES + ('roles', 'sroles')), force=True)
+
+        log.info('Imported snapshot of "{}" ({})'.format(header['server'], path),
+                 server=server, action='snapshot_import', duration=time.time() - started)
+
+        await self.reply(message, 'Imported snapshot of "{server}" from {date}: {counts}'\
+                         .format(server=header['server'],
+                                 date=time.strftime('%d/%m %H:%M', time.localtime(header['created'])),
+                                 counts=', '.join('{} {}'.format(len(tables[t]), t) \
+                                                  for t in TABLES)))
+
+    # Report the pick & ban statistics, as a CSV file if `args` is `csv`
+    async def map_stats(self, message, args):
+        server = message.server
+
+        if not self.check_server(server):
+            return
+
+        stats = MapStats(self.db[server]['stats'])
+        parts = args.split()
+
+        if 'csv' in parts:
+            data = io.BytesIO(stats.to_csv().encode())
+            filename = 'mapstats-{}.csv'.format(self.config['servers'][server.name]['db'])
+            try:
+                await self.client.send_file(message.channel,
+                                            data,
+                                            filename=filename,
+                                            content='{} Here are the map statistics'\
+                                            .format(message.author.mention))
+            except Exception as e:
+                log.error('Failed to send map statistics')
+                raise e
+            data.close()
+            return
+
+        formats = [ f for f in stats.formats() if not parts or f in parts ]
+
+        if not formats:
+            await self.reply(message, 'No statistics yet')
+            return
+
+        await self.reply(message, '\n```\n{}\n```'\
+                         .format('\n\n'.join([ stats.render(f) for f in formats ])))
+
+    # Report internal queue metrics
+    async def metrics(self, message):
+        server = message.server
+
+        if not self.check_server(server):
+            return
+
+        depths = self.mailboxes.depths(server.id)
+        busy = sorted([ (depth, key[1]) for key, depth in depths.items() if depth > 0 ],
+                      reverse=True)
+
+        lines = [ 'Match mailboxes: {count} ({busy} busy, max depth {max})'\
+                  .format(count=len(depths),
+                          busy=len(busy),
+                          max=self.mailboxes.max_depth(server.id)) ]
+        lines += [ ' - {:<40} {}'.format(name, depth) for depth, name in busy[:10] ]
+        lines.append('Timers: {}'.format(len(self.timers)))
+        lines.append('Permission cache: {size} member(s), {hits} hit(s), {misses} miss(es)'\
+                     .format(size=len(self.permissions),
+                             hits=self.permissions.hits,
+                             misses=self.permissions.misses))
+        lines.append('Join queue: {depth} pending (max {max}), {processed} processed, {merged} merged, {failed} failed, wait {avg:.1f}s avg / {max_wait:.1f}s max'\
+                     .format(depth=len(self.joins),
+                             max=self.joins.max_depth,
+                             processed=self.joins.processed,
+                             merged=self.joins.merged,
+                             failed=self.joins.failed,
+                             avg=self.joins.average_wait(),
+                             max_wait=self.joins.max_wait))
+        interactive, bulk = self.scheduler.waiting()
+        lines.append('Scheduler: {running}/{capacity} running ({bulk_running} bulk, {reserved} reserved), waiting {interactive} interactive / {bulk} bulk ({here} here), max wait {iwait:.1f}s interactive / {bwait:.1f}s bulk'\
+                     .format(running=self.scheduler.running,
+                             capacity=self.scheduler.capacity,
+                             bulk_running=self.scheduler.running_bulk,
+                             reserved=self.scheduler.reserved,
+                             interactive=interactive,
+                             bulk=bulk,
+                             here=self.scheduler.waiting(server.id)[1],
+                             iwait=self.scheduler.max_wait[False],
+                             bwait=self.scheduler.max_wait[True]))
+        lines.append('Digests: {} pending event(s)'.format(self.digests.count()))
+        lines.append('Outbox: {pending} pending, {messages} messages in {posts} posts'\
+                     .format(pending=self.outbox.pending(),
+                             messages=self.outbox.messages,
+                             posts=self.outbox.posts))
+
+        await self.reply(message, '\n```\n{}\n```'.format('\n'.join(lines)))
+
 
 class Handle:
     def __init__(self, bot, member, channel):
@@ -772,36 +2320,57 @@ class Handle:
 
         if member:
             try:
-                self.team = bot.db[member.server]['captains'][str(member)].team # TODO cup
+                captain = bot.db[member.server]['captains'][str(member)] # TODO cup
+                if captain.team_id:
+                    self.team = RoleRef(captain.team_id,
+                                        bot.config['roles']['team'].format(captain.team_name))
             except KeyError:
                 pass
 
     async def reply(self, msg):
+        if not self.member:
+            return await self.send(msg)
         return await self.send('{} {}'.format(self.member.mention, msg))
 
+    # Queue a message in the channel outbox, returns a future of the posted
+    # message. Messages of one handler are merged into as few posts as
+    # possible, see Outbox
     async def send(self, msg):
-        try:
-            return await self.bot.client.send_message(self.channel, msg)
-        except discord.errors.HTTPException as e:
-            print('WARNING: HTTPexception: {}'.format(str(e)))
-            await asyncio.sleep(10)
-            return await self.send(msg)
+        return self.bot.outbox.send(self.channel, msg)
+
+    # Statistics of the server of this channel
+    def stats(self):
+        return MapStats(self.bot.db[self.channel.server]['stats'])
 
-    async def broadcast(self, bcast_id, msg):
+    # Publish a pick & ban event of the match of this channel
+    def publish(self, type, data):
+        self.bot.publish(self.channel.server, self.channel.name, type, data)
+
+    # Send `msg` to all the rooms of broadcast `bcast_id`. If the broadcast
+    # has a digest window, `compact` (or `msg`) is aggregated with the other
+    # events of the window instead
+    async def broadcast(self, bcast_id, msg, compact=None):
+        server = self.channel.server
         channels = []
         try:
-            channels = self.bot.config['servers'][self.channel.server.name]['rooms'][bcast_id]
+            channels = self.bot.config['servers'][server.name]['rooms'][bcast_id]
         except:
-            print('WARNING: No broadcast configuration for "{}"'.format(bcast_id))
+            log.warning('No broadcast configuration for "{}"'.format(bcast_id))
             pass
 
+        targets = []
         for channel_name in channels:
-            channel = discord.utils.get(self.channel.server.channels, name=channel_name)
+            channel = self.bot.get_channel(server, name=channel_name)
             if channel:
-                try:
-                    await self.bot.client.send_message(channel, msg)
-                except:
-                    print('WARNING: No permission to write in "{}"'.format(channel_name))
-                    pass
+                targets.append(channel)
             else:
-                print ('WARNING: Missing channel {}'.format(channel_name))
+                log.warning('Missing channel {}'.format(channel_name))
+
+        window = self.bot.get_digest_window(server, bcast_id)
+
+        if window:
+            self.bot.digests.add(server, bcast_id, targets, compact or msg, window)
+            return
+
+        for channel in targets:
+            self.bot.outbox.send(channel, msg)
@@ -0,0 +1,49 @@
+# The MIT License (MIT)
+# Copyright (c) 2017 Levak Borok <levak92@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+### Index of the roles of a server by ID
+#
+# Persistent state only holds role IDs, this resolves them to the live role
+# objects. The index is built on first use and dropped whenever a role of
+# the server is created, deleted or updated.
+class RoleIndex:
+    def __init__(self, server):
+        self.server = server
+        self.by_id = None
+
+    def get(self, role_id):
+        if role_id is None:
+            return None
+
+        if self.by_id is None:
+            self.by_id = { role.id: role for role in self.server.roles }
+
+        return self.by_id.get(role_id)
+
+    def invalidate(self):
+        self.by_id = None
+
+# Returns the ID of a role or of a legacy pickled role object
+def role_id(role):
+    if role is None or isinstance(role, str):
+        return role
+    return role.id
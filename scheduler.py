@@ -0,0 +1,150 @@
+# The MIT License (MIT)
+# Copyright (c) 2017 Levak Borok <levak92@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+import asyncio
+import collections
+
+### Fair scheduler of the Discord calls of all servers
+#
+# At most `capacity` calls run at once. Interactive calls (commands of
+# captains and referees, match room messages) go first and may use every
+# slot, while bulk calls (refresh, wipes, join storms) never use the last
+# `reserved` ones, so interactive commands always find a free slot within
+# one call of latency. Bulk calls wait in one queue per server, served
+# round-robin so that a long job on one server cannot starve another.
+#
+#   async with scheduler.slot(server.id, bulk=True):
+#       await client.delete_role(server, role)
+class FairScheduler:
+    def __init__(self, capacity=8, reserved=2):
+        self.running = 0
+        self.running_bulk = 0
+        self.interactive = collections.deque()
+        self.bulk = collections.OrderedDict()
+
+        self.granted = { False: 0, True: 0 }
+        self.max_wait = { False: 0, True: 0 }
+
+        self.resize(capacity, reserved)
+
+    def resize(self, capacity, reserved):
+        self.capacity = max(1, capacity)
+        self.reserved = min(max(0, reserved), self.capacity - 1)
+        self.dispatch()
+
+    def slot(self, server_id, bulk=False):
+        return Slot(self, server_id, bulk)
+
+    async def acquire(self, server_id, bulk=False):
+        loop = asyncio.get_event_loop()
+        waiter = loop.create_future()
+        queued = loop.time()
+
+        if bulk:
+            self.bulk.setdefault(server_id, collections.deque()).append(waiter)
+        else:
+            self.interactive.append(waiter)
+
+        self.dispatch()
+
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            # Granted just before being cancelled, give the slot back
+            if waiter.done() and not waiter.cancelled():
+                self.release(bulk)
+            raise
+
+        self.granted[bulk] += 1
+        self.max_wait[bulk] = max(self.max_wait[bulk], loop.time() - queued)
+
+    def release(self, bulk=False):
+        self.running -= 1
+        if bulk:
+            self.running_bulk -= 1
+        self.dispatch()
+
+    def grant(self, waiter, bulk):
+        self.running += 1
+        if bulk:
+            self.running_bulk += 1
+        waiter.set_result(None)
+
+    def dispatch(self):
+        while self.running < self.capacity:
+            # 1. Interactive calls first
+            while self.interactive and self.interactive[0].done():
+                self.interactive.popleft()
+
+            if self.interactive:
+                self.grant(self.interactive.popleft(), False)
+                continue
+
+            # 2. Bulk calls, one server after the other, out of the reserve
+            if self.running_bulk >= self.capacity - self.reserved:
+                break
+
+            waiter = self.next_bulk()
+            if waiter is None:
+                break
+
+            self.grant(waiter, True)
+
+    # Pop the next bulk waiter of the next server in turn, and move that
+    # server to the end of the round
+    def next_bulk(self):
+        while self.bulk:
+            server_id, queue = next(iter(self.bulk.items()))
+
+            while queue and queue[0].done():
+                queue.popleft()
+
+            if not queue:
+                del self.bulk[server_id]
+                continue
+
+            waiter = queue.popleft()
+            self.bulk.move_to_end(server_id)
+            if not queue:
+                del self.bulk[server_id]
+
+            return waiter
+
+        return None
+
+    def waiting(self, server_id=None):
+        interactive = len(self.interactive)
+        bulk = sum(len(q) for s, q in self.bulk.items() \
+                   if server_id is None or s == server_id)
+        return interactive, bulk
+
+class Slot:
+    def __init__(self, scheduler, server_id, bulk):
+        self.scheduler = scheduler
+        self.server_id = server_id
+        self.bulk = bulk
+
+    async def __aenter__(self):
+        await self.scheduler.acquire(self.server_id, self.bulk)
+
+    async def __aexit__(self, *exc):
+        self.scheduler.release(self.bulk)
@@ -0,0 +1,99 @@
+# The MIT License (MIT)
+# Copyright (c) 2017 Levak Borok <levak92@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+import bisect
+import collections
+
+from inputs import sanitize_input, translit_input
+
+def normalize(name):
+    return sanitize_input(translit_input(name))
+
+def trigrams(key):
+    padded = '  {} '.format(key)
+    return set(padded[i:i+3] for i in range(len(padded) - 2))
+
+### Search index of the team names of a server
+#
+# Names are transliterated and sanitized like every other input. A query is
+# looked up, in order, as an exact name, as a name prefix (bisect in the
+# sorted names) and as a fuzzy name (trigram similarity). Lookups return
+# the role names of the teams found, more than one meaning the query is
+# ambiguous.
+class TeamIndex:
+    # Minimum trigram similarity of a fuzzy match, and how close to the best
+    # one the other fuzzy matches must be to be reported as ambiguous
+    FUZZY_THRESHOLD = 0.35
+    FUZZY_MARGIN = 0.1
+
+    def __init__(self, teams):
+        entries = sorted((normalize(team.name), role_name) \
+                         for role_name, team in teams.items())
+
+        self.keys = [ key for key, _ in entries ]
+        self.role_names = [ role_name for _, role_name in entries ]
+        self.grams = [ trigrams(key) for key in self.keys ]
+
+        self.postings = collections.defaultdict(list)
+        for i, grams in enumerate(self.grams):
+            for gram in grams:
+                self.postings[gram].append(i)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def find(self, query, limit=10):
+        key = normalize(query)
+
+        if not key:
+            return []
+
+        # 1. Exact name
+        lo = bisect.bisect_left(self.keys, key)
+        hi = bisect.bisect_right(self.keys, key)
+        if lo < hi:
+            return self.role_names[lo:hi][:limit]
+
+        # 2. Name prefix, all the names between `key` and the next string
+        #    that does not start with it
+        hi = bisect.bisect_left(self.keys, key[:-1] + chr(ord(key[-1]) + 1))
+        if lo < hi:
+            return self.role_names[lo:hi][:limit]
+
+        # 3. Fuzzy name
+        grams = trigrams(key)
+        shared = collections.Counter()
+        for gram in grams:
+            for i in self.postings.get(gram, ()):
+                shared[i] += 1
+
+        scores = sorted(((count / (len(grams) + len(self.grams[i]) - count), i) \
+                         for i, count in shared.items()),
+                        reverse=True)
+        scores = [ (score, i) for score, i in scores if score >= self.FUZZY_THRESHOLD ]
+
+        if not scores:
+            return []
+
+        best = scores[0][0]
+        return [ self.role_names[i] for score, i in scores \
+                 if score >= best - self.FUZZY_MARGIN ][:limit]
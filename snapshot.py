@@ -0,0 +1,279 @@
+#! /usr/bin/env python3
+
+# The MIT License (MIT)
+# Copyright (c) 2017 Levak Borok <levak92@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+# Portable snapshots of the tournament state of a server: captains, teams,
+# groups, matches, schedule, rooms and statistics, independent of the dbm
+# flavour and of pickled classes.
+#
+# A snapshot is a gzip stream of JSON lines, written and read one record at
+# a time:
+#   {"format": "rolekeeper-snapshot", "version": 1, "server": ..., ...}
+#   {"table": "captains", "key": ..., "value": ...}
+#   ...
+#   {"end": {"captains": 123, ...}}
+# The end line holds the record count of every table, a truncated file is
+# refused.
+#
+# Usage, on the DB of a server while the bot is stopped:
+#   ./snapshot.py export config.json "Server name" snapshot.jsonl.gz
+#   ./snapshot.py import config.json "Server name" snapshot.jsonl.gz
+# or with `!snapshot export` and `!snapshot import` while it runs.
+
+import argparse
+import gzip
+import json
+import sys
+import time
+
+from db import open_db
+from team import Team, TeamCaptain, RoleRef
+from match import Match
+from formats import intern_format
+
+SNAPSHOT_FORMAT = 'rolekeeper-snapshot'
+SNAPSHOT_VERSION = 1
+
+TABLES = ( 'groups', 'teams', 'captains', 'matches', 'schedule', 'rooms', 'stats' )
+
+def dump_match(match):
+    format = match.format
+    return { 'teams': [ [ t.id, t.name ] for t in match.teams ],
+             'maps': list(match.maps),
+             'format': { 'name': format.name,
+                         'map_count': format.map_count,
+                         'steps': format.steps,
+                         'welcome': format.welcome,
+                         'summary_title': format.summary_title,
+                         'summary_maps': format.summary_maps,
+                         'summary_footer': format.summary_footer },
+             'banned': list(match.banned_maps),
+             'picked': list(match.picked_maps),
+             'side': match.chosen_side,
+             'turn': match.turn,
+             'created': getattr(match, 'created', None),
+             'deadline': getattr(match, 'deadline', None),
+             'deadline_turn': getattr(match, 'deadline_turn', None),
+             'reminded': getattr(match, 'reminded', False) }
+
+def load_match(value):
+    f = value['format']
+    format = intern_format(f['name'],
+                           f['map_count'],
+                           tuple(tuple(step) for step in f['steps']),
+                           f['welcome'],
+                           f['summary_title'],
+                           tuple(tuple(entry) for entry in f['summary_maps']),
+                           f['summary_footer'])
+
+    teamA, teamB = [ RoleRef(id, name) for id, name in value['teams'] ]
+    match = Match(teamA, teamB, value['maps'], format)
+    match.banned_maps = value['banned']
+    match.picked_maps = value['picked']
+    match.chosen_side = value['side']
+    match.turn = value['turn']
+    match.created = value['created']
+    match.deadline = value['deadline']
+    match.deadline_turn = value['deadline_turn']
+    match.reminded = value['reminded']
+
+    return match
+
+def dump_captain(captain):
+    return { 'discord': captain.discord,
+             'team_name': captain.team_name,
+             'nickname': captain.nickname,
+             'group': captain.group,
+             'team_id': getattr(captain, 'team_id', None) }
+
+def load_captain(value):
+    captain = TeamCaptain(value['discord'], value['team_name'], value['nickname'], value['group'])
+    captain.team_id = value['team_id']
+    return captain
+
+# (dump, load) of the values of every table, by key
+CODECS = {
+    'groups': (lambda v: v, lambda v: v),
+    'teams': (lambda t: { 'name': t.name, 'role_id': t.role_id },
+              lambda v: Team(v['name'], v['role_id'])),
+    'captains': (dump_captain, load_captain),
+    'matches': (dump_match, load_match),
+    'schedule': (lambda v: v, lambda v: v),
+    'stats': (lambda v: v, lambda v: v),
+}
+
+# Yield the snapshot lines of the server DB `db`, header and end line
+# included. Only reads the DB, values are converted as they are yielded
+def snapshot_lines(db, server_name=None, db_name=None):
+    yield { 'format': SNAPSHOT_FORMAT,
+            'version': SNAPSHOT_VERSION,
+            'server': server_name,
+            'db': db_name,
+            'created': time.time() }
+
+    counts = {}
+    for table in TABLES:
+        counts[table] = 0
+
+        if table == 'rooms':
+            for name in sorted(db.get('rooms', ())):
+                counts[table] += 1
+                yield { 'table': table, 'key': name, 'value': True }
+            continue
+
+        dump, _ = CODECS[table]
+        for key, value in db.get(table, {}).items():
+            counts[table] += 1
+            yield { 'table': table, 'key': key, 'value': dump(value) }
+
+    yield { 'end': counts }
+
+# Write snapshot `lines` to `path`, returns the record counts
+def write_snapshot(path, lines):
+    counts = None
+    with gzip.open(path, 'wt', encoding='utf-8') as f:
+        for line in lines:
+            f.write(json.dumps(line, ensure_ascii=False, sort_keys=True))
+            f.write('\n')
+            counts = line.get('end', counts)
+
+    return counts
+
+# Read the snapshot at `path`, returns its header and its tables, as loaded
+# values by key. Raises ValueError if the file is not a complete snapshot of
+# a supported version
+def read_snapshot(path):
+    tables = { table: {} for table in TABLES }
+    tables['rooms'] = set()
+    header = None
+    end = None
+
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for number, text in enumerate(f, 1):
+            if not text.strip():
+                continue
+
+            try:
+                line = json.loads(text)
+            except ValueError as e:
+                raise ValueError('line {}: {}'.format(number, e))
+
+            if header is None:
+                if line.get('format') != SNAPSHOT_FORMAT:
+                    raise ValueError('not a snapshot')
+                if line.get('version') != SNAPSHOT_VERSION:
+                    raise ValueError('unsupported snapshot version {}'.format(line.get('version')))
+                header = line
+                continue
+
+            if 'end' in line:
+                end = line['end']
+                break
+
+            table = line.get('table')
+            if table not in tables:
+                raise ValueError('line {}: unknown table "{}"'.format(number, table))
+
+            try:
+                if table == 'rooms':
+                    tables[table].add(line['key'])
+                else:
+                    tables[table][line['key']] = CODECS[table][1](line['value'])
+            except (KeyError, TypeError, ValueError) as e:
+                raise ValueError('line {}: invalid {} record: {}'.format(number, table, e))
+
+    if header is None:
+        raise ValueError('empty snapshot')
+
+    if end is None:
+        raise ValueError('truncated snapshot')
+
+    for table in TABLES:
+        if end.get(table, 0) != len(tables[table]):
+            raise ValueError('{} {} record(s) instead of {}'\
+                             .format(table, len(tables[table]), end.get(table, 0)))
+
+    return header, tables
+
+# Replace the tables of the server DB `db` with the ones of a snapshot. The
+# caches of the previous state (role IDs, refresh progress) are dropped
+def restore_tables(db, tables):
+    for table in TABLES:
+        db[table] = tables[table]
+
+    db['roles'] = {}
+    db['sroles'] = {}
+    db.pop('refresh', None)
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='RoleKeeper tournament state snapshots')
+    parser.add_argument('action', choices=( 'export', 'import' ))
+    parser.add_argument('config', help='path of config.json')
+    parser.add_argument('server', help='name of the server, as in config.json')
+    parser.add_argument('path', help='snapshot file')
+    args = parser.parse_args(argv)
+
+    try:
+        with open(args.config, 'r') as f:
+            config = json.load(f)
+    except (OSError, ValueError) as e:
+        print('ERROR while loading config "{}": {}'.format(args.config, e))
+        return 1
+
+    if args.server not in config['servers']:
+        print('ERROR: Unknown server "{}"'.format(args.server))
+        return 1
+
+    db_name = config['servers'][args.server]['db']
+    db = open_db(db_name)
+    if db is None:
+        return 1
+
+    started = time.time()
+    try:
+        if args.action == 'export':
+            counts = write_snapshot(args.path, snapshot_lines(db, args.server, db_name))
+        else:
+            try:
+                header, tables = read_snapshot(args.path)
+            except (OSError, ValueError) as e:
+                print('ERROR: Cannot import "{}": {}'.format(args.path, e))
+                return 1
+
+            if db.get('teardown'):
+                print('ERROR: A wipe of {} is still pending in this DB'.format(db['teardown']['kind']))
+                return 1
+
+            restore_tables(db, tables)
+            counts = { table: len(tables[table]) for table in TABLES }
+    finally:
+        db.close()
+
+    print('{action}ed "{path}" in {duration:.2f}s: {counts}'\
+          .format(action=args.action.capitalize(),
+                  path=args.path,
+                  duration=time.time() - started,
+                  counts=', '.join('{} {}'.format(counts[t], t) for t in TABLES)))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,126 @@
+# The MIT License (MIT)
+# Copyright (c) 2017 Levak Borok <levak92@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+import csv
+import io
+
+### Incremental pick & ban statistics of a server, per format
+#
+# Wraps the plain dict kept in `db[server]['stats']`:
+#   { format: { 'matches': N,
+#               'sides': { side: N },
+#               'maps': { map: { 'pool': N, 'ban': N, 'pick': N,
+#                                'played': N, side: N } } } }
+# Counters are updated as matches are played, rendering them never scans
+# the match archive.
+class MapStats:
+    def __init__(self, data):
+        self.data = data
+
+    def format_stats(self, format):
+        if format not in self.data:
+            self.data[format] = { 'matches': 0, 'sides': {}, 'maps': {} }
+        return self.data[format]
+
+    def map_stats(self, format, map_id):
+        maps = self.format_stats(format)['maps']
+        if map_id not in maps:
+            maps[map_id] = { 'pool': 0, 'ban': 0, 'pick': 0, 'played': 0 }
+        return maps[map_id]
+
+    # Count a new match of `format` on the map pool `maps`
+    def count_match(self, format, maps):
+        self.format_stats(format)['matches'] += 1
+        for map_id in maps:
+            self.map_stats(format, map_id)['pool'] += 1
+
+    # Count a ban or a pick of map `map_id`
+    def count_map(self, format, action, map_id):
+        self.map_stats(format, map_id)[action] += 1
+
+    def count_side(self, format, side):
+        sides = self.format_stats(format)['sides']
+        sides[side] = sides.get(side, 0) + 1
+
+    # Count map `map_id` as played, with the chosen `side`
+    def count_played(self, format, map_id, side):
+        stats = self.map_stats(format, map_id)
+        stats['played'] += 1
+        if side:
+            stats[side] = stats.get(side, 0) + 1
+
+    def formats(self):
+        return sorted(self.data.keys())
+
+    # Returns the rows of `format` as (map, pool, ban, pick, played, sides),
+    # most banned maps last
+    def rows(self, format):
+        stats = self.data.get(format, { 'maps': {} })
+        sides = sorted(self.data.get(format, {}).get('sides', {}).keys())
+
+        rows = []
+        for map_id, counts in stats['maps'].items():
+            rows.append((map_id,
+                         counts['pool'],
+                         counts['ban'],
+                         counts['pick'],
+                         counts['played'],
+                         { side: counts.get(side, 0) for side in sides }))
+
+        return sorted(rows, key=lambda r: (r[2] / r[1] if r[1] else 0, r[0]))
+
+    def render(self, format):
+        stats = self.data[format]
+        total = sum(stats['sides'].values())
+
+        lines = [ '{format}: {n} match(es){sides}'\
+                  .format(format=format,
+                          n=stats['matches'],
+                          sides=''.join([ ', {} {:.0%}'.format(side, count / total) \
+                                          for side, count in sorted(stats['sides'].items()) ])) ]
+        lines.append('  {:<15} {:>6} {:>6} {:>7}'.format('Map', 'Ban', 'Pick', 'Played'))
+
+        for map_id, pool, ban, pick, played, sides in self.rows(format):
+            lines.append('  {:<15} {:>6.0%} {:>6.0%} {:>7}  {}'\
+                         .format(map_id,
+                                 ban / pool if pool else 0,
+                                 pick / pool if pool else 0,
+                                 played,
+                                 ', '.join([ '{} {:.0%}'.format(side, count / played) \
+                                             for side, count in sorted(sides.items()) \
+                                             if played ])).rstrip())
+
+        return '\n'.join(lines)
+
+    def to_csv(self):
+        sides = sorted(set(s for f in self.data.values() for s in f['sides']))
+
+        output = io.StringIO()
+        writer = csv.writer(output)
+        writer.writerow([ '#format', 'map', 'matches', 'ban', 'pick', 'played' ] + sides)
+
+        for format in self.formats():
+            for map_id, pool, ban, pick, played, counts in self.rows(format):
+                writer.writerow([ format, map_id, pool, ban, pick, played ] \
+                                + [ counts.get(side, 0) for side in sides ])
+
+        return output.getvalue()
@@ -19,15 +19,47 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
 # IN THE SOFTWARE.
 
+### Persistent reference to a Discord role, by snowflake ID
+#
+# Compares equal to any role object with the same ID. The name is only kept
+# for display, the live role is resolved through RoleKeeper.resolve_role.
+class RoleRef:
+    __slots__ = ( 'id', 'name' )
+
+    def __init__(self, id, name):
+        self.id = id
+        self.name = name
+
+    @property
+    def mention(self):
+        return '<@&{}>'.format(self.id)
+
+    def __eq__(self, other):
+        return getattr(other, 'id', None) == self.id
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __str__(self):
+        return self.name
+
+def role_ref(role):
+    if role is None or isinstance(role, RoleRef):
+        return role
+    return RoleRef(role.id, role.name)
+
 ### Class that holds information about a team
 class Team:
-    def __init__(self, name, role):
+    def __init__(self, name, role_id):
         self.name = name
-        self.role = role
+        self.role_id = role_id
 
     def __str__(self):
         return '{name} ({role})'\
-            .format(name=self.name, role=str(self.role))
+            .format(name=self.name, role=self.role_id)
 
 ### Class that holds information about a team captain
 class TeamCaptain:
@@ -36,8 +68,8 @@ class TeamCaptain:
         self.team_name = team_name
         self.nickname = nickname
         self.group = group
+        self.team_id = None
 
     def __str__(self):
         return '{nick} - {team} - Group {g} ({id})'\
             .format(nick=self.nickname, team=self.team_name, id=self.discord, g=self.group)
-
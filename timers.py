@@ -0,0 +1,109 @@
+# The MIT License (MIT)
+# Copyright (c) 2017 Levak Borok <levak92@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+import asyncio
+import heapq
+import itertools
+import time
+
+from log import get_log
+
+log = get_log(__name__)
+
+### Heap scheduler running every timer of the bot from one background task
+#
+# Timers are keyed: scheduling a key again replaces its previous timer, and
+# cancelled or replaced entries are lazily dropped when they reach the top of
+# the heap. Deadlines are wall-clock timestamps so they can be persisted and
+# re-armed after a restart.
+class Timers:
+    def __init__(self):
+        self.heap = []
+        self.entries = {}
+        self.counter = itertools.count()
+        self.wakeup = None
+        self.task = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.wakeup = asyncio.Event()
+            self.task = asyncio.ensure_future(self.run())
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    # Call coroutine function `callback(*args)` at timestamp `when`
+    def schedule(self, key, when, callback, *args):
+        self.cancel(key)
+
+        entry = [ when, next(self.counter), key, callback, args ]
+        self.entries[key] = entry
+        heapq.heappush(self.heap, entry)
+
+        # Wake the runner up if this timer is now the next one to fire
+        if self.wakeup and self.heap[0] is entry:
+            self.wakeup.set()
+
+    def cancel(self, key):
+        entry = self.entries.pop(key, None)
+        if entry:
+            entry[3] = None
+
+    def when(self, key):
+        entry = self.entries.get(key)
+        return entry[0] if entry else None
+
+    async def run(self):
+        while True:
+            # Drop cancelled and replaced entries
+            while self.heap and self.heap[0][3] is None:
+                heapq.heappop(self.heap)
+
+            timeout = None
+            if self.heap:
+                timeout = max(0, self.heap[0][0] - time.time())
+
+            self.wakeup.clear()
+            if timeout is None or timeout > 0:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            _, _, key, callback, args = heapq.heappop(self.heap)
+            del self.entries[key]
+
+            # Do not let a slow callback delay the other timers
+            task = asyncio.ensure_future(callback(*args))
+            task.add_done_callback(self.check_failure(key))
+
+    def check_failure(self, key):
+        def done(task):
+            if not task.cancelled() and task.exception():
+                log.error('Timer "{}" failed: {}'.format(key, task.exception()),
+                          action='timer')
+        return done